@@ -16,17 +16,80 @@
 # limitations under the License.
 #
 
+import os
 import sys
 import json
 import logging
+import argparse
 
 from nomad.utils import configure_logging
 from nomad.datamodel import EntryArchive
 from atkparser import ATKParser
+from atkparser.atk_parser import all_quantities
+from atkparser.batch import parse_files, stream_files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m atkparser', description='Parses ATK NetCDF files to NOMAD archives.')
+    parser.add_argument('paths', nargs='+', help='ATK files or directories to parse.')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of worker processes for batch parsing, defaults to the number of CPUs.')
+    parser.add_argument(
+        '--jsonl', action='store_true',
+        help=(
+            'Stream one compact JSON record per section. With a single worker or a single file '
+            'each record is written as soon as its section is parsed, otherwise as soon as its '
+            'file is parsed.'))
+    parser.add_argument(
+        '--quantities', nargs='+', choices=sorted(all_quantities), default=None,
+        help='Only parse the given sections and calculation results, defaults to all.')
+    parser.add_argument(
+        '--hdf5', action='store_true',
+        help='Also parse the experimental HDF5 output of QuantumATK, requires h5py.')
+    args = parser.parse_args(argv)
+
+    single_file = len(args.paths) == 1 and not os.path.isdir(args.paths[0])
+
+    if args.jsonl:
+        # a single file is streamed in process, its records are written while it is parsed
+        workers = 1 if single_file and args.workers is None else args.workers
+        failed = 0
+        for filepath, record, error in stream_files(
+                args.paths, workers=workers, quantities=args.quantities, hdf5=args.hdf5):
+            if error is None:
+                record = dict(mainfile=filepath, **record)
+            else:
+                failed += 1
+                logging.error('Failed to parse %s: %s' % (filepath, error))
+                record = dict(mainfile=filepath, error=error)
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+        return 1 if failed else 0
+
+    if single_file and args.workers is None:
+        archive = EntryArchive()
+        ATKParser(quantities=args.quantities, hdf5=args.hdf5).parse(args.paths[0], archive, logging)
+        json.dump(archive.m_to_dict(), sys.stdout, indent=2)
+        return 0
+
+    # batch mode, one json record per file written as soon as it is parsed
+    failed = 0
+    for filepath, archive, error in parse_files(
+            args.paths, workers=args.workers, quantities=args.quantities, hdf5=args.hdf5):
+        if error is None:
+            record = dict(mainfile=filepath, archive=archive)
+        else:
+            failed += 1
+            logging.error('Failed to parse %s: %s' % (filepath, error))
+            record = dict(mainfile=filepath, error=error)
+        sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
     configure_logging(console_log_level=logging.DEBUG)
-    archive = EntryArchive()
-    ATKParser().parse(sys.argv[1], archive, logging)
-    json.dump(archive.m_to_dict(), sys.stdout, indent=2)
+    sys.exit(main())
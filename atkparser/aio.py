@@ -0,0 +1,132 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import asyncio
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from nomad.datamodel import EntryArchive
+
+from .atk_parser import ATKParser, materialize
+from .batch import find_mainfiles
+
+
+class AsyncParser:
+    '''
+    Asyncio interface to the ATK parser. Files are parsed in a pool of max_workers
+    threads, each with its own ATKParser created with kwargs, and at most max_open files
+    are open at the same time. A parse which is cancelled or exceeds its timeout is
+    stopped after the section in progress and its file is closed.
+    '''
+    def __init__(self, max_workers=4, max_open=None, timeout=None, **kwargs):
+        self.max_open = max_open if max_open is not None else max_workers
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local()
+        self._open_files = None
+
+    def _parse(self, filepath, archive, logger, cancelled, to_dict=False):
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = self._local.parser = ATKParser(**self.kwargs)
+
+        sections = parser.iter_sections(filepath, archive, logger)
+        try:
+            for section in sections:
+                if cancelled.is_set():
+                    break
+                materialize(section)
+            if parser.mainfile_parser is parser.nc_parser and parser.nc_parser.netcdf is None:
+                raise ValueError('Not a NetCDF or HDF5 file')
+        finally:
+            sections.close()
+            parser.reset()
+
+        # the archive is serialized in the worker, large archives would block the event loop
+        return archive.m_to_dict() if to_dict else archive
+
+    async def parse(self, filepath, archive=None, logger=None, timeout=None):
+        '''
+        Parses filepath into archive without blocking the event loop and returns the
+        archive. Raises asyncio.TimeoutError if parsing takes longer than timeout seconds.
+        '''
+        return await self._submit(filepath, archive, logger, timeout)
+
+    async def _submit(self, filepath, archive=None, logger=None, timeout=None, to_dict=False):
+        archive = archive if archive is not None else EntryArchive()
+        timeout = timeout if timeout is not None else self.timeout
+        if self._open_files is None:
+            self._open_files = asyncio.Semaphore(self.max_open)
+
+        async with self._open_files:
+            cancelled = threading.Event()
+            future = self._executor.submit(self._parse, filepath, archive, logger, cancelled, to_dict)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                # the worker can only be stopped between sections, the file counts as
+                # open until it is done
+                cancelled.set()
+                if not future.cancel():
+                    await asyncio.wait([asyncio.wrap_future(future)])
+                raise
+
+    async def _parse_file(self, filepath, timeout):
+        try:
+            if not os.path.isfile(filepath):
+                raise FileNotFoundError('No such file')
+            archive = await self._submit(filepath, logger=logging.getLogger(__name__), timeout=timeout, to_dict=True)
+            return filepath, archive, None
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            return filepath, None, 'TimeoutError: parsing exceeded %ss' % timeout
+        except Exception as e:
+            return filepath, None, '%s: %s' % (e.__class__.__name__, e)
+
+    async def parse_files(self, paths, timeout=None):
+        '''
+        Parses the files and directories in paths concurrently and yields tuples of the
+        file path, the archive as dictionary and an error message as soon as each file is
+        done. Remaining files are cancelled when the iteration is stopped.
+        '''
+        timeout = timeout if timeout is not None else self.timeout
+        # directories are searched in the pool, the search would block the event loop
+        mainfiles = await asyncio.get_event_loop().run_in_executor(
+            self._executor, partial(find_mainfiles, hdf5=self.kwargs.get('hdf5', False)), paths)
+        tasks = [asyncio.ensure_future(self._parse_file(mainfile, timeout)) for mainfile in mainfiles]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await asyncio.get_event_loop().run_in_executor(None, self.close)
@@ -17,153 +17,991 @@
 # limitations under the License.
 #
 import os
+import hashlib
 import numpy as np
 import re
+import struct
 import logging
+import warnings
+from collections import OrderedDict, deque
 from scipy.io.netcdf import netcdf_file
-from ase.data import atomic_names
+from ase.data import atomic_names, chemical_symbols
 from ase import lattice as aselattice, Atoms
 
 from nomad.units import ureg
 from nomad.parsing.parser import FairdiParser
+from nomad.datamodel import EntryArchive
 from nomad.parsing.file_parser import FileParser, TextParser, Quantity
 from nomad.datamodel.metainfo.common_dft import Run, BasisSetAtomCentered, Method, XCFunctionals,\
-    System, SingleConfigurationCalculation
+    System, SingleConfigurationCalculation, SystemToSystemRefs, KBand, KBandSegment, Eigenvalues
+
+from .profiler import Profiler
+
+try:
+    import h5py
+except ImportError:
+    # HDF5 files are only parsed with the optional h5py
+    h5py = None
+
+
+_conversion_factors: dict = dict()
+
+# the sections and calculation results which can be requested from the parsers
+all_quantities = frozenset(['system', 'method', 'energies', 'forces', 'stress', 'band_structure', 'eigenvalues'])
+
+# the names of the mainfiles, HDF5 files are only matched with hdf5
+mainfile_name_re = r'^.*\.nc'
+hdf5_mainfile_name_re = r'^.*\.(nc|hdf5|h5)$'
+
+_re_configuration = re.compile(r'Configuration_gID\d+')
+
+_nc_types = {
+    1: np.dtype('b'), 2: np.dtype('c'), 3: np.dtype('>i2'), 4: np.dtype('>i4'), 5: np.dtype('>f4'),
+    6: np.dtype('>f8')}
+
+
+def read_header(filepath, variables=False):
+    '''
+    Reads the dimensions and global attributes from the header of a NetCDF classic file
+    without mapping the file or reading the variables. With variables, the names of the
+    variables are read as well and returned as third item. Returns None if filepath is
+    not a NetCDF classic file.
+    '''
+    try:
+        with open(filepath, 'rb') as f:
+            magic = f.read(4)
+            if magic not in [b'CDF\x01', b'CDF\x02']:
+                return
+
+            def read_int():
+                return struct.unpack('>i', f.read(4))[0]
+
+            def read_values(n_bytes):
+                values = f.read(n_bytes)
+                f.read(-n_bytes % 4)
+                return values
+
+            # number of records
+            read_int()
+            dimensions = dict()
+            read_int()
+            for _ in range(read_int()):
+                name = read_values(read_int()).decode()
+                dimensions[name] = read_int()
+
+            def read_attributes():
+                attributes = dict()
+                read_int()
+                for _ in range(read_int()):
+                    name = read_values(read_int()).decode()
+                    dtype = _nc_types[read_int()]
+                    values = read_values(read_int() * dtype.itemsize)
+                    attributes[name] = values if dtype.char == 'c' else np.frombuffer(values, dtype)
+                return attributes
+
+            attributes = read_attributes()
+            if not variables:
+                return dimensions, attributes
+
+            names = []
+            read_int()
+            for _ in range(read_int()):
+                names.append(read_values(read_int()).decode())
+                # dimension ids, attributes, type, size and offset of the data
+                f.read(4 * read_int())
+                read_attributes()
+                f.read(12 if magic == b'CDF\x01' else 16)
+
+        return dimensions, attributes, names
+    except Exception:
+        pass
+
+
+def is_hdf5(filepath):
+    '''
+    Returns whether filepath is an HDF5 file. Without h5py, only the signature of the
+    file is checked.
+    '''
+    if h5py is not None:
+        return h5py.is_hdf5(filepath)
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(8) == b'\x89HDF\r\n\x1a\n'
+    except OSError:
+        return False
+
+
+def log_warning(logger, event, **kwargs):
+    '''
+    Logs a warning with structured data, given as keyword arguments to nomad loggers and
+    as extra of the record to loggers of the standard library.
+    '''
+    if logger is logging or isinstance(logger, logging.Logger):
+        exc_info = kwargs.pop('exc_info', None)
+        logger.warning(event, exc_info=exc_info, extra=kwargs)
+    else:
+        logger.warning(event, **kwargs)
+
+
+def conversion_factor(units, unit):
+    '''
+    Returns the factor converting values in units to unit, pint is only used once for
+    each pair of units.
+    '''
+    factor = _conversion_factors.get((units, unit))
+    if factor is None:
+        factor = ureg.Quantity(1., units).to(unit).magnitude
+        _conversion_factors[(units, unit)] = factor
+    return factor
+
+
+def is_atk_netcdf(filepath):
+    '''
+    Checks from the header of the NetCDF file at filepath whether it was written by ATK,
+    i.e. whether it has a fingerprint table or version and configuration dimensions or
+    variables.
+    '''
+    header = read_header(filepath)
+    if header is None:
+        return False
+    dimensions, attributes = header
+    if 'fingerprint_table' not in attributes and 'version' not in attributes:
+        return False
+    if any(_re_configuration.search(name) for name in dimensions):
+        return True
+    header = read_header(filepath, variables=True)
+    return header is not None and any(_re_configuration.search(name) for name in header[2])
+
+
+def is_atk_hdf5(filepath):
+    '''
+    Checks from the root of the HDF5 file at filepath whether it was written by
+    QuantumATK, i.e. whether it has a fingerprint table or version attribute and
+    configuration groups. Always False without h5py.
+    '''
+    if h5py is None:
+        return False
+    try:
+        with h5py.File(filepath, 'r') as f:
+            if 'fingerprint_table' not in f.attrs and 'version' not in f.attrs:
+                return False
+            return any(
+                _re_configuration.search(name) and f.get(name, getclass=True) is h5py.Group
+                for name in f.keys())
+    except Exception:
+        return False
+
+
+def to_magnitude(value, unit):
+    '''
+    Returns the magnitude of the pint quantity value in unit as a native float64 array.
+    The conversion is done in a single pass, values which are read-only views on the
+    memory-mapped file are thus not copied before landing in the archive.
+    '''
+    return np.multiply(value.magnitude, conversion_factor(value.units, unit), dtype=np.float64)
+
+
+class Structure:
+    '''
+    Atomic numbers, cartesian positions (angstrom), velocities (angstrom/fs), cell
+    (angstrom) and periodicity of a configuration.
+    '''
+    __slots__ = ['numbers', 'positions', 'velocities', 'cell', 'pbc']
+
+    def __init__(self, numbers, positions, velocities=None, cell=None, pbc=False):
+        self.numbers = numbers
+        self.positions = positions
+        self.velocities = velocities
+        self.cell = cell
+        self.pbc = pbc
+
+    @property
+    def symbols(self):
+        return [chemical_symbols[n] for n in self.numbers]
+
+    def to_atoms(self):
+        '''
+        Returns the structure as ASE atoms.
+        '''
+        atoms = Atoms(numbers=self.numbers, positions=self.positions, pbc=self.pbc)
+        if self.cell is not None:
+            atoms.set_cell(self.cell)
+        if self.velocities is not None:
+            atoms.set_velocities(self.velocities)
+        return atoms
+
+
+class HandlePool:
+    '''
+    Bounded pool of the file parsers with an open file. Once more than max_open files are
+    open, the file of the least recently opened parser is closed. The parsers reopen
+    their file when it is accessed again.
+    '''
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self._parsers = OrderedDict()
+
+    def __len__(self):
+        return len(self._parsers)
+
+    def add(self, parser):
+        self._parsers[id(parser)] = parser
+        self._parsers.move_to_end(id(parser))
+        while len(self._parsers) > self.max_open:
+            _, parser = self._parsers.popitem(last=False)
+            parser.close()
+
+    def discard(self, parser):
+        self._parsers.pop(id(parser), None)
+
+    def close(self):
+        for parser in list(self._parsers.values()):
+            parser.close()
+        self._parsers.clear()
 
 
 class NCParser(FileParser):
     def __init__(self):
         super().__init__()
+        # the pool which bounds the number of open files, if any
+        self.pool = None
         self._configuration_types = ['MoleculeConfiguration', 'BulkConfiguration']
-        self._units = dict(angstrom=ureg.angstrom, bohr=ureg.bohr, kelvin=ureg.kelvin)
+        self.profiler = Profiler()
+        # factors of the length units of the lattice parameters to angstrom
+        self._length_factors = {
+            unit: conversion_factor(getattr(ureg, unit), ureg.angstrom)
+            for unit in ['angstrom', 'bohr', 'nanometer', 'meter']}
+        self._re_variable = re.compile(r'(\w+?)\_(gID\d+)(?:\_(\S+))?$')
+        self._re_assignment = re.compile(rb'\n(\w+) *\= *')
+        self._re_first_assignment = re.compile(rb'(\w+) *\= *')
+        self._re_array_end = re.compile(rb'\]\s*\]')
+        self._re_list = re.compile(rb'\[(.+)\]')
+        self._re_lattice = re.compile(rb'(\w+) *\((.+)\)')
+        self._re_f = r'[\d\.\-\+Ee]+'
+        # maximum number of bytes of eigenvalues converted at once
+        self.chunk_size = 1 << 22
+        self._lattices = dict(
+            FaceCenteredCubic=aselattice.FCC, BodyCenteredCubic=aselattice.BCC, Triclinic=aselattice.TRI)
+        # lookup table mapping all but the characters of floats to whitespace
+        self._float_chars = np.full(256, ord(' '), dtype=np.uint8)
+        for char in b'0123456789.-+eE':
+            self._float_chars[char] = char
+        self._atomic_numbers = {name: number for number, name in enumerate(atomic_names)}
+        # the quantities the configuration handles refer to, None for all
+        self.quantities = None
+        self._fingerprints = dict()
+        self._variables = dict()
+
+    def init_parameters(self):
         self._fingerprints = dict()
+        self._variables = dict()
+
+    @FileParser.mainfile.setter
+    def mainfile(self, val):
+        # the file of the previous mainfile is closed before the state is reset
+        self.close()
+        FileParser.mainfile.fset(self, val)
+
+    def close(self):
+        '''
+        Closes the file, the parsed results are kept and the file is reopened when it
+        is accessed again.
+        '''
+        if self.pool is not None:
+            self.pool.discard(self)
+        if self._file_handler is not None:
+            with warnings.catch_warnings():
+                # arrays which still refer to the mapped file keep the mapping alive
+                # until they are released
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self._file_handler.close()
+            self._file_handler = None
 
     @property
     def netcdf(self):
         if self._file_handler is None:
-            try:
-                self._file_handler = netcdf_file(self.mainfile, mmap=True)
-            except Exception:
-                return
-            # prepare fingerprints required for variables
-            if hasattr(self._file_handler, 'fingerprint_table'):
-                fprints = [p.split(':') for p in self._file_handler.fingerprint_table.decode().split('#') if p]  # pylint: disable=maybe-no-member
-                self._fingerprints = {p[1]: p[0] for p in fprints}
+            with self.profiler.stage('open'):
+                try:
+                    self._file_handler = netcdf_file(self.mainfile, mmap=True)
+                except Exception:
+                    return
+                if self.pool is not None:
+                    self.pool.add(self)
+                # prepare fingerprints required for variables
+                if hasattr(self._file_handler, 'fingerprint_table'):
+                    fprints = [p.split(':') for p in self._file_handler.fingerprint_table.decode().split('#') if p]  # pylint: disable=maybe-no-member
+                    self._fingerprints = {p[1]: p[0] for p in fprints}
+                self._index_variables()
 
         return self._file_handler
 
+    def _index_variables(self):
+        # classify all variables by gID in a single pass, all quantities are then served
+        # from the index instead of scanning the full list of variables for each key
+        index = dict(
+            configuration=dict(), calculator=dict(), energies=dict(), finger_print=dict(),
+            forces=dict(), stress=dict(), bandstructure=dict(), eigenvalues=dict())
+        for name in self._file_handler.variables.keys():
+            variable = self._re_variable.match(name)
+            if variable is None:
+                continue
+            prefix, gid, suffix = variable.groups()
+            if suffix is None:
+                if prefix.endswith('Configuration'):
+                    index['configuration'][gid] = name
+            elif suffix == 'calculator':
+                if prefix.endswith('Configuration'):
+                    index['calculator'][gid] = name
+            elif suffix == 'finger_print':
+                index['finger_print'][gid] = name
+            elif prefix == 'TotalEnergy' and suffix.startswith('component_'):
+                index['energies'].setdefault(gid, dict())[suffix[10:]] = name
+            elif prefix == 'Forces' and suffix == 'atom_resolved_forces':
+                index['forces'][gid] = name
+            elif prefix == 'Stress' and suffix == 'stress':
+                index['stress'][gid] = name
+            elif prefix in ['Bandstructure', 'Eigenvalues']:
+                index[prefix.lower()].setdefault(gid, dict())[suffix] = name
+
+        self._variables = index
+
+    def _get_finger_print(self, gid):
+        name = self._variables['finger_print'].get(gid)
+        if name is None:
+            return
+        return self._file_handler.variables[name].data.tobytes().decode()
+
+    def _get_result_names(self, kind):
+        # maps the finger print of the configuration to the variables of the result
+        names = dict()
+        for gid, name in self._variables[kind].items():
+            fp = self._get_finger_print(gid)
+            if fp is not None:
+                names[fp] = name
+        return names
+
+    def _read_text(self, name):
+        return self.netcdf.variables[name].data.tobytes().decode()
+
+    def _resolve_fermi_level(self, variables):
+        # the fermi level in eV, the eigenvalues are given relative to it
+        if 'fermi_level' not in variables:
+            return 0.
+        variable = self.netcdf.variables[variables['fermi_level']]
+        unit = getattr(variable, 'unit', b'eV').decode()
+        try:
+            unit = ureg.parse_units(unit)
+        except Exception:
+            unit = ureg.parse_units(unit.lower())
+        return float(variable.data[0]) * conversion_factor(unit, ureg.eV)
+
+    def _read_eigenvalues(self, variables, start=0, end=None):
+        # eigenvalues of the k-points start to end for all spins in eV as one
+        # (n_spins, n_kpoints, n_bands) array, filled from the mmap chunk by chunk
+        spins = [
+            self.netcdf.variables[variables[name]].data[start:end]
+            for name in ['eigenvalues_up', 'eigenvalues_down'] if name in variables]
+        if not spins:
+            return
+        fermi_level = self._resolve_fermi_level(variables)
+        eigenvalues = np.empty((len(spins),) + spins[0].shape, dtype=np.float64)
+        rows = max(1, self.chunk_size // max(1, spins[0][:1].nbytes))
+        with self.profiler.stage('eigenvalues', nbytes=eigenvalues.nbytes):
+            for spin, values in enumerate(spins):
+                for row in range(0, len(values), rows):
+                    np.add(values[row: row + rows], fermi_level, out=eigenvalues[spin, row: row + rows])
+        return eigenvalues
+
+    def _resolve_band_segments(self, variables):
+        # yields the labels, k-points and eigenvalues of each segment of the route of
+        # the band structure, only the eigenvalues of one segment are in memory at once
+        if any(key not in variables for key in ['kpoints', 'route', 'keys_symmetry_points', 'values_symmetry_points']):
+            return
+        kpoints = self.netcdf.variables[variables['kpoints']].data
+        points = dict(zip(
+            self._read_text(variables['keys_symmetry_points']).split('.'),
+            self.netcdf.variables[variables['values_symmetry_points']].data))
+        start = 0
+        for segment in self._read_text(variables['route']).split(','):
+            labels = segment.strip().split('.')
+            first, last = [], []
+            if len(labels) == 2 and labels[0] in points and labels[1] in points:
+                first = np.flatnonzero(np.isclose(kpoints[start:], points[labels[0]]).all(axis=1))
+                if len(first) > 0:
+                    last = np.flatnonzero(np.isclose(kpoints[start + first[0] + 1:], points[labels[1]]).all(axis=1))
+            if len(last) == 0:
+                log_warning(
+                    self.logger, 'Could not match the band structure route leg to the k-points, the '
+                    'remaining segments are skipped', route_leg=segment.strip())
+                return
+            start += first[0]
+            end = start + 1 + last[0]
+            yield labels, kpoints[start: end + 1], self._read_eigenvalues(variables, start, end + 1)
+            start = end
+
     def resolve_unit(self, val):
         val = val.split('*')
         if len(val) == 2:
-            return (float(val[0]) * self._units.get(val[1].lower(), ureg.angstrom)).to('angstrom').magnitude
+            return float(val[0]) * self._length_factors.get(val[1].strip().lower(), 1.)
         return float(val[0])
 
-    def _resolve_configuration(self, data):
+    def _to_array(self, buffer, start):
+        # converts the nested list at start to an (n, 3) array in one go, only the block
+        # itself is copied when translating it to whitespace separated floats
+        if buffer[start: start + 1].tobytes() != b'[':
+            return
+        end = self._re_array_end.search(buffer, start)
+        if end is None:
+            return
+        values = np.fromstring(self._float_chars[buffer[start: end.end()]], sep=' ')
+        if values.size % 3:
+            return
+        return values.reshape((-1, 3))
 
-        # TODO implement UnitCell, ghost atoms
+    def _tokenize(self, data):
+        # the configuration script is tokenized directly on the memory-mapped bytes
+        buffer = data.data.view(np.uint8)
+        tokens = {m.group(1): m.end() for m in self._re_assignment.finditer(buffer)}
+        first = self._re_first_assignment.match(buffer)
+        if first is not None:
+            tokens.setdefault(first.group(1), first.end())
+        return buffer, tokens
 
-        lattices = dict(
-            FaceCenteredCubic=aselattice.FCC, BodyCenteredCubic=aselattice.BCC, Triclinic=aselattice.TRI)
+    def _resolve_elements(self, buffer, tokens):
+        elements = self._re_list.match(buffer, tokens.get(b'elements', len(buffer)))
+        if not elements:
+            return
 
-        re_f = r'[\d\.\-\+Ee]+'
+        try:
+            return np.array([self._atomic_numbers[e.strip().title()] for e in elements.group(1).decode().split(',')])
+        except Exception:
+            pass
 
-        data = data.data[:].copy().tobytes().decode()
+    def _resolve_configuration(self, name, data):
+        with self.profiler.stage('configuration', name.rsplit('_', 1)[-1], data.data.nbytes):
+            return self._decode_configuration(name, data)
 
-        elements = re.search(r'elements = \[(.+)\]', data)
-        if not elements:
+    def _decode_configuration(self, name, data):
+
+        # TODO implement UnitCell, ghost atoms
+
+        buffer, tokens = self._tokenize(data)
+
+        numbers = self._resolve_elements(buffer, tokens)
+        if numbers is None:
             return
 
-        coordinates = re.search(r'coordinates *\= *(\[\s*\[[\s\S]+?\]\s*\])', data)
+        coordinates = [key for key in tokens if key.endswith(b'coordinates')]
         if not coordinates:
             return
 
         try:
-            numbers = [atomic_names.index(e.strip().title()) for e in elements.group(1).split(',')]
-
-            positions = np.array([v.split(',') for v in re.findall(
-                rf'\[( *{re_f} *\, *{re_f} *\, *{re_f} *)\]', coordinates.group(1))], dtype=np.dtype(np.float64))
-
-            atoms = Atoms(numbers=numbers, positions=positions)
-
+            positions = self._to_array(buffer, tokens[coordinates[-1]])
         except Exception:
             return
+        if positions is None or len(positions) != len(numbers):
+            return
 
-        velocities = re.search(r'velocities *\= *(\[\s*\[[\s\S]+?\]\s*\])', data)
-        if velocities:
-            atoms.set_velocities(np.array([v.split(',') for v in re.findall(
-                rf'\[( *{re_f} *\, *{re_f} *\, *{re_f} *)\]', velocities.group(1))], dtype=np.dtype(np.float64)))
-
-        if 'MoleculeConfiguration' in data:
-            return atoms
+        velocities = self._to_array(buffer, tokens.get(b'velocities', len(buffer)))
 
-        atoms.set_pbc(True)
+        if name.startswith('MoleculeConfiguration'):
+            return Structure(numbers, positions, velocities)
 
-        lattice = re.search(r'\nlattice = (\w+) *\((.+)\)', data)
-        lattice, parameters = lattice.groups() if lattice else ('', '')
-        parameters = [self.resolve_unit(p) for p in re.findall(rf'({re_f} *\* *\w+)', parameters)]
-        lattice = lattices.get(lattice)
+        lattice = self._re_lattice.match(buffer, tokens.get(b'lattice', len(buffer)))
+        lattice, parameters = [g.decode() for g in lattice.groups()] if lattice else ('', '')
+        parameters = [self.resolve_unit(p) for p in re.findall(rf'({self._re_f} *\* *\w+)', parameters)]
+        lattice = self._lattices.get(lattice)
         if lattice is None:
             return
 
         try:
-            atoms.set_cell(lattice(*parameters).tocell(), scale_atoms='fractional' in data)
+            cell = np.array(lattice(*parameters).tocell())
         except Exception:
-            pass
+            return Structure(numbers, positions, velocities, pbc=True)
 
-        return atoms
+        if coordinates[-1].startswith(b'fractional'):
+            positions = positions @ cell
+
+        return Structure(numbers, positions, velocities, cell, pbc=True)
+
+    def _stack_trajectory(self):
+        # decodes all configurations into preallocated (n_frames, n_atoms, 3) arrays of
+        # positions and velocities (angstrom, angstrom/fs), forces (eV/angstrom) and
+        # (n_frames, 3, 3) cells with the gID, fingerprint and name of each frame. Frames
+        # which cannot be decoded are left out, missing velocities and forces are nan.
+        names = self._variables['configuration']
+        forces = self._get_result_names('forces')
+        n_frames = len(names)
+        trajectory = dict(gids=[], fingerprints=[], names=[])
+        frame = 0
+        for gid, name in names.items():
+            structure = self._resolve_configuration(name, self.netcdf.variables[name])
+            if structure is None:
+                continue
+
+            numbers, positions, velocities, cell = [
+                structure.numbers, structure.positions, structure.velocities, structure.cell]
+            if frame == 0:
+                n_atoms = len(numbers)
+                trajectory.update(
+                    numbers=numbers, positions=np.empty((n_frames, n_atoms, 3)),
+                    velocities=np.full((n_frames, n_atoms, 3), np.nan), cells=np.zeros((n_frames, 3, 3)),
+                    forces=np.full((n_frames, n_atoms, 3), np.nan))
+            elif not np.array_equal(trajectory['numbers'], numbers):
+                self.logger.warning('Configurations with different atoms are no trajectory.')
+                return
+
+            fp = self._fingerprints.get(gid)
+            trajectory['positions'][frame] = positions
+            if velocities is not None:
+                trajectory['velocities'][frame] = velocities
+            if cell is not None:
+                trajectory['cells'][frame] = cell
+            if forces.get(fp) is not None:
+                trajectory['forces'][frame] = self.netcdf.variables[forces[fp]].data
+            trajectory['gids'].append(gid)
+            trajectory['fingerprints'].append(fp)
+            trajectory['names'].append(name)
+            frame += 1
+
+        if frame == 0:
+            return
+        for key in ['positions', 'velocities', 'cells', 'forces']:
+            trajectory[key] = trajectory[key][:frame]
+        for key in ['velocities', 'forces']:
+            if np.isnan(trajectory[key]).all():
+                trajectory[key] = None
+        return trajectory
+
+    def _stack_energies(self, components):
+        # energy components as names and an array of the values in eV
+        return list(components.keys()), np.array(
+            [self.netcdf.variables[name].data[0] for name in components.values()], dtype=np.float64)
 
     def parse(self, key):
-        val = None
-        if hasattr(self.netcdf, key):
-            val = getattr(self.netcdf, key)
-            if isinstance(val, bytes):
-                val = val.decode()
-        elif key == 'configuration_names':
-            val = []
-            re_name = re.compile(r'(\w+Configuration\_gID\d+)$')
-            for name in self.netcdf.variables.keys():
-                name = re.match(re_name, name)
-                if name:
-                    val.append(name.group(1))
-        elif key == 'atoms':
-            val = dict()
-            for name in self.get('configuration_names', []):
-                data = self.netcdf.variables.get(name)
-                if data is None:
-                    continue
-                val[name] = self._resolve_configuration(data)
-        elif key == 'parameters':
-            val = dict()
-            for name in self.get('configuration_names', []):
-                data = self.netcdf.variables.get('%s_calculator' % name)
-                if data is None:
-                    continue
-                val[name] = data.data.tobytes()
-        elif key == 'energies':
-            val = dict()
-            # energy_keys = [k for k in self.netcdf.variables.keys() if k.startswith('TotalEnergy')]
-            energy_re = r'TotalEnergy\_(gID\d+)\_component\_(\S+)'
-            for key_n in self.netcdf.variables.keys():
-                energy_key = re.match(energy_re, key_n)
-                if energy_key:
-                    fp = self.netcdf.variables[
-                        'TotalEnergy_%s_finger_print' % energy_key.group(1)].data.tobytes().decode()
-                    val.setdefault(fp, {})
-                    val[fp][energy_key.group(2)] = self.netcdf.variables[key_n].data[0] * ureg.eV
-        elif key == 'forces':
-            val = dict()
-            forces_re = r'Forces\_(gID\d+)\_atom\_resolved\_forces'
-            for key_n in self.netcdf.variables.keys():
-                forces_key = re.match(forces_re, key_n)
-                if forces_key:
-                    fp = self.netcdf.variables[
-                        'TotalEnergy_%s_finger_print' % forces_key.group(1)].data.tobytes().decode()
-                    val[fp] = self.netcdf.variables[key_n].data * (ureg.eV / ureg.angstrom)
-
-        # TODO implement stress, bandstructure, eigenvalues
+        with self.profiler.stage(key):
+            val = None
+            if self.netcdf is None:
+                pass
+            elif hasattr(self.netcdf, key):
+                val = getattr(self.netcdf, key)
+                if isinstance(val, bytes):
+                    val = val.decode()
+            elif key == 'configuration_names':
+                val = list(self._variables['configuration'].values())
+            elif key == 'configurations':
+                # the variables of quantities which are not requested are not touched
+                quantities = self.quantities if self.quantities is not None else all_quantities
+                val = dict()
+                energies = dict()
+                if 'energies' in quantities:
+                    for gid, components in self._variables['energies'].items():
+                        fp = self._get_finger_print(gid)
+                        if fp is not None:
+                            energies.setdefault(fp, dict()).update(components)
+                results = {
+                    kind: self._get_result_names(kind) for kind, quantity in [
+                        ('forces', 'forces'), ('stress', 'stress'), ('bandstructure', 'band_structure'),
+                        ('eigenvalues', 'eigenvalues')] if quantity in quantities}
+                calculators = self._variables['calculator'] if 'method' in quantities else dict()
+                for gid, name in self._variables['configuration'].items():
+                    fp = self._fingerprints.get(gid)
+                    val[name] = Configuration(
+                        self, name, fingerprint=fp, calculator=calculators.get(gid),
+                        energies=energies.get(fp), **{kind: names.get(fp) for kind, names in results.items()})
+            elif key in ['structures', 'atoms']:
+                val = dict()
+                for name in self._variables['configuration'].values():
+                    structure = self._resolve_configuration(name, self.netcdf.variables[name])
+                    # ASE atoms are only created on request
+                    val[name] = structure.to_atoms() if key == 'atoms' and structure is not None else structure
+            elif key == 'parameters':
+                val = dict()
+                for gid, name in self._variables['configuration'].items():
+                    calculator = self._variables['calculator'].get(gid)
+                    if calculator is None:
+                        continue
+                    val[name] = self.netcdf.variables[calculator].data.tobytes()
+            elif key == 'energies':
+                val = dict()
+                for gid, components in self._variables['energies'].items():
+                    fp = self._get_finger_print(gid)
+                    if fp is None:
+                        continue
+                    val[fp] = self._stack_energies(components)
+            elif key == 'trajectory':
+                val = self._stack_trajectory()
+            elif key == 'forces':
+                val = dict()
+                for fp, name in self._get_result_names('forces').items():
+                    val[fp] = ureg.Quantity(self.netcdf.variables[name].data, ureg.eV / ureg.angstrom)
+            elif key == 'stress':
+                val = dict()
+                for fp, name in self._get_result_names('stress').items():
+                    val[fp] = ureg.Quantity(self.netcdf.variables[name].data, ureg.eV / ureg.angstrom ** 3)
+            elif key == 'band_segments':
+                val = dict()
+                for fp, variables in self._get_result_names('bandstructure').items():
+                    val[fp] = list(self._resolve_band_segments(variables))
+            elif key == 'eigenvalues':
+                val = dict()
+                for fp, variables in self._get_result_names('eigenvalues').items():
+                    if 'kpoints' in variables:
+                        val[fp] = self.netcdf.variables[variables['kpoints']].data, self._read_eigenvalues(variables)
+
         self._results[key] = val
 
 
+class Configuration:
+    '''
+    Handle on a configuration in the NetCDF file of nc_parser. The structure, calculator and
+    the results of the calculation are only decoded from the memory-mapped file when
+    accessed. The file is accessed through nc_parser, which reopens it if it was closed.
+    '''
+    def __init__(
+            self, nc_parser, name, fingerprint=None, calculator=None, energies=None, forces=None,
+            stress=None, bandstructure=None, eigenvalues=None):
+        self.name = name
+        self.fingerprint = fingerprint
+        self.periodic = not name.startswith('MoleculeConfiguration')
+        self._nc_parser = nc_parser
+        self._calculator = calculator
+        self._energies = energies if energies is not None else dict()
+        self._forces = forces
+        self._stress = stress
+        self._bandstructure = bandstructure
+        self._eigenvalues = eigenvalues
+        self._tokens = None
+        self._structure = None
+
+    @property
+    def _netcdf(self):
+        return self._nc_parser.netcdf
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = self._nc_parser._resolve_configuration(
+                self.name, self._netcdf.variables[self.name])
+        return self._structure
+
+    @property
+    def atoms(self):
+        if self.structure is not None:
+            return self.structure.to_atoms()
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = self._nc_parser._tokenize(self._netcdf.variables[self.name])
+        return self._tokens
+
+    @property
+    def atom_labels(self):
+        if self._structure is not None:
+            return self._structure.symbols
+        numbers = self._nc_parser._resolve_elements(*self.tokens)
+        if numbers is not None:
+            return [chemical_symbols[n] for n in numbers]
+
+    @property
+    def has_velocities(self):
+        if self._structure is not None:
+            return self._structure.velocities is not None
+        return b'velocities' in self.tokens[1]
+
+    @property
+    def parameters(self):
+        if self._calculator is not None:
+            return self._netcdf.variables[self._calculator].data.tobytes()
+
+    @property
+    def energies(self):
+        return self._nc_parser._stack_energies(self._energies)
+
+    def release(self):
+        # the structure is decoded again on next access
+        self._structure = None
+        self._tokens = None
+
+    @property
+    def has_forces(self):
+        return self._forces is not None
+
+    @property
+    def forces(self):
+        # read-only view on the memory-mapped file
+        if self._forces is not None:
+            return ureg.Quantity(self._netcdf.variables[self._forces].data, ureg.eV / ureg.angstrom)
+
+    @property
+    def stress(self):
+        if self._stress is not None:
+            return ureg.Quantity(self._netcdf.variables[self._stress].data, ureg.eV / ureg.angstrom ** 3)
+
+    @property
+    def fermi_level(self):
+        for variables in [self._bandstructure, self._eigenvalues]:
+            if variables is not None and 'fermi_level' in variables:
+                return self._nc_parser._resolve_fermi_level(variables)
+
+    @property
+    def band_segments(self):
+        # generator over the labels, k-points and eigenvalues (eV) of the segments
+        if self._bandstructure is not None:
+            return self._nc_parser._resolve_band_segments(self._bandstructure)
+
+    @property
+    def eigenvalues(self):
+        if self._eigenvalues is not None and 'kpoints' in self._eigenvalues:
+            return (
+                self._netcdf.variables[self._eigenvalues['kpoints']].data,
+                self._nc_parser._read_eigenvalues(self._eigenvalues))
+
+
+class HDF5Parser(FileParser):
+    '''
+    Experimental parser for the HDF5 output of QuantumATK. The objects of the file are
+    assumed to be stored as groups which are named like the NetCDF variables, e.g.
+    BulkConfiguration_gID000, this layout is not validated against QuantumATK output yet.
+    The results are served under the same keys as for NCParser. Datasets are only read when
+    accessed and numeric datasets are read in chunks of at most chunk_size bytes into
+    the resulting array, memory is thus bounded by the largest single configuration.
+    '''
+    def __init__(self, chunk_size=1 << 22):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self._re_group = re.compile(r'(\w+?)\_(gID\d+)$')
+        self.profiler = Profiler()
+        self.quantities = None
+        self.pool = None
+
+    def init_parameters(self):
+        self._fingerprints = dict()
+        self._groups = dict()
+
+    @FileParser.mainfile.setter
+    def mainfile(self, val):
+        self.close()
+        FileParser.mainfile.fset(self, val)
+
+    def close(self):
+        '''
+        Closes the file, the parsed results are kept and the file is reopened when it
+        is accessed again.
+        '''
+        if self.pool is not None:
+            self.pool.discard(self)
+        if self._file_handler is not None:
+            self._file_handler.close()
+            self._file_handler = None
+
+    @property
+    def hdf5(self):
+        if self._file_handler is None and h5py is not None:
+            with self.profiler.stage('open'):
+                try:
+                    self._file_handler = h5py.File(self.mainfile, 'r')
+                except Exception:
+                    return
+                if self.pool is not None:
+                    self.pool.add(self)
+                fingerprint_table = self._file_handler.attrs.get('fingerprint_table', '')
+                if isinstance(fingerprint_table, bytes):
+                    fingerprint_table = fingerprint_table.decode()
+                fprints = [p.split(':') for p in fingerprint_table.split('#') if p]
+                self._fingerprints = {p[1]: p[0] for p in fprints}
+                self._index_groups()
+
+        return self._file_handler
+
+    def _index_groups(self):
+        index = dict(configuration=dict(), energies=dict(), forces=dict())
+        for name, group in self._file_handler.items():
+            match = self._re_group.match(name)
+            if match is None or not isinstance(group, h5py.Group):
+                continue
+            prefix, gid = match.groups()
+            if prefix.endswith('Configuration'):
+                index['configuration'][gid] = name
+            elif prefix == 'TotalEnergy':
+                index['energies'][gid] = name
+            elif prefix == 'Forces':
+                index['forces'][gid] = name
+        self._groups = index
+
+    def _get_finger_print(self, name):
+        finger_print = self.hdf5[name].attrs.get('finger_print')
+        if isinstance(finger_print, bytes):
+            finger_print = finger_print.decode()
+        return finger_print
+
+    def _get_result_names(self, kind):
+        names = dict()
+        for name in self._groups[kind].values():
+            fp = self._get_finger_print(name)
+            if fp is not None:
+                names[fp] = name
+        return names
+
+    def read(self, dataset, dtype=np.float64):
+        '''
+        Reads dataset into a new array of dtype, chunk by chunk along the first axis.
+        '''
+        if dataset.shape == ():
+            return dataset[()]
+        out = np.empty(dataset.shape, dtype=dtype)
+        if out.size == 0:
+            return out
+        rows = max(1, self.chunk_size // max(1, out[0].nbytes))
+        with self.profiler.stage('read', nbytes=out.nbytes):
+            for start in range(0, len(out), rows):
+                selection = np.s_[start: start + rows]
+                dataset.read_direct(out, selection, selection)
+        return out
+
+    def parse(self, key):
+        with self.profiler.stage(key):
+            val = None
+            if self.hdf5 is None:
+                pass
+            elif key in self.hdf5.attrs:
+                val = self.hdf5.attrs[key]
+                if isinstance(val, bytes):
+                    val = val.decode()
+            elif key == 'configuration_names':
+                val = list(self._groups['configuration'].values())
+            elif key == 'configurations':
+                quantities = self.quantities if self.quantities is not None else all_quantities
+                val = dict()
+                energies = self._get_result_names('energies') if 'energies' in quantities else dict()
+                forces = self._get_result_names('forces') if 'forces' in quantities else dict()
+                for gid, name in self._groups['configuration'].items():
+                    fp = self._fingerprints.get(gid)
+                    val[name] = HDF5Configuration(
+                        self, name, fingerprint=fp, energies=energies.get(fp), forces=forces.get(fp))
+            elif key in ['structures', 'atoms', 'parameters']:
+                val = dict()
+                for configuration in self.get('configurations', {}).values():
+                    value = getattr(configuration, key)
+                    if value is not None:
+                        val[configuration.name] = value
+            elif key in ['energies', 'forces']:
+                val = dict()
+                for configuration in self.get('configurations', {}).values():
+                    if configuration.fingerprint is not None:
+                        val[configuration.fingerprint] = getattr(configuration, key)
+
+        self._results[key] = val
+
+
+class HDF5Configuration:
+    '''
+    Handle on a configuration group in the HDF5 file of hdf5_parser with the same interface
+    as the NetCDF configuration handles. The datasets are only read when accessed and the
+    file is accessed through hdf5_parser, which reopens it if it was closed. Stress, band
+    structure and eigenvalue results are not read from HDF5 files.
+    '''
+    def __init__(self, hdf5_parser, name, fingerprint=None, energies=None, forces=None):
+        self.name = name
+        self.fingerprint = fingerprint
+        self.periodic = not name.startswith('MoleculeConfiguration')
+        self._hdf5_parser = hdf5_parser
+        self._energies = energies
+        self._forces = forces
+        self._structure = None
+
+    @property
+    def _group(self):
+        return self._hdf5_parser.hdf5[self.name]
+
+    @property
+    def structure(self):
+        if self._structure is None and 'elements' in self._group:
+            read = self._hdf5_parser.read
+            with self._hdf5_parser.profiler.stage('configuration', self.name.rsplit('_', 1)[-1]):
+                try:
+                    numbers = read(self._group['elements'], np.int64)
+                    positions = read(self._group['cartesian_coordinates'])
+                except Exception:
+                    return
+                if len(positions) != len(numbers):
+                    return
+                structure = Structure(numbers, positions)
+                if self.has_velocities:
+                    structure.velocities = read(self._group['velocities'])
+                if self.periodic:
+                    structure.pbc = True
+                    if 'primitive_vectors' in self._group:
+                        structure.cell = read(self._group['primitive_vectors'])
+            self._structure = structure
+        return self._structure
+
+    @property
+    def atoms(self):
+        if self.structure is not None:
+            return self.structure.to_atoms()
+
+    @property
+    def atom_labels(self):
+        if 'elements' in self._group:
+            return [chemical_symbols[n] for n in self._hdf5_parser.read(self._group['elements'], np.int64)]
+
+    @property
+    def has_velocities(self):
+        return 'velocities' in self._group
+
+    @property
+    def parameters(self):
+        if 'calculator' in self._group:
+            calculator = self._group['calculator'][()]
+            return calculator.encode() if isinstance(calculator, str) else bytes(calculator)
+
+    @property
+    def energies(self):
+        if self._energies is None:
+            return [], np.zeros(0)
+        group = self._hdf5_parser.hdf5[self._energies]
+        names = [name for name in group.keys() if name.startswith('component_')]
+        return [name[len('component_'):] for name in names], np.array(
+            [group[name][()] for name in names], dtype=np.float64)
+
+    @property
+    def has_forces(self):
+        return self._forces is not None
+
+    @property
+    def forces(self):
+        if self._forces is not None:
+            dataset = self._hdf5_parser.hdf5[self._forces]['atom_resolved_forces']
+            return ureg.Quantity(self._hdf5_parser.read(dataset), ureg.eV / ureg.angstrom)
+
+    stress = fermi_level = band_segments = eigenvalues = None
+
+    def release(self):
+        self._structure = None
+
+
+def is_deferred(section):
+    '''
+    Returns whether the quantities of section were deferred by a lazy parser and are
+    not decoded yet, their values are None until section is materialized.
+    '''
+    return 'atk_deferred' in section.m_annotations
+
+
+def materialize(section):
+    '''
+    Decodes the quantities of section and all its sub sections which were deferred by a
+    lazy parser, e.g. materialize(archive) for a whole archive.
+    '''
+    sections = [section] + list(section.m_all_contents())
+    for section in sections:
+        load = section.m_annotations.pop('atk_deferred', None)
+        if load is not None:
+            load()
+
+
 class CalculatorParser(TextParser):
     def __init__(self):
         super().__init__()
@@ -177,13 +1015,53 @@ class CalculatorParser(TextParser):
 
 
 class ATKParser(FairdiParser):
-    def __init__(self):
+    '''
+    Parser for the NetCDF output of ATK and the experimental HDF5 output of QuantumATK.
+    The parser can be reused for any number of files, reset or use it as context manager
+    to close all of them.
+
+    Arguments:
+        lazy: the sections yielded by iter_sections only contain the program version,
+            the method sections and the energies and stress of the calculations. The
+            systems, the calculator settings and the remaining results are decoded by
+            materialize. Archives returned by parse are always complete.
+        cache: a ResultsCache to store the decoded results on disk and reuse them for
+            unchanged files.
+        share_systems: systems with the same species and cell as a previous system only
+            store the positions and velocities and refer to the previous system.
+        profile: record the time and memory of the parsing stages in profiler.
+        quantities: a subset of all_quantities, only the requested sections and
+            calculation results are parsed.
+        max_open: the maximum number of files which are kept open at the same time.
+        incremental: parsing a growing file again into the same archive only appends
+            the configurations and calculations which were not parsed before.
+        hdf5: also match and parse the experimental HDF5 output of QuantumATK.
+    '''
+    def __init__(
+            self, lazy=False, cache=None, share_systems=False, profile=False, quantities=None, max_open=16,
+            incremental=False, hdf5=False):
         super().__init__(
             name='parsers/atk', code_name='AtomistixToolKit',
             code_homepage='https://www.synopsys.com/silicon/quantumatk.html',
-            mainfile_name_re=r'^.*\.nc', mainfile_mime_re=r'application/octet-stream')
+            mainfile_name_re=hdf5_mainfile_name_re if hdf5 else mainfile_name_re,
+            mainfile_mime_re=r'application/(octet-stream|x-hdf5?)' if hdf5 else r'application/octet-stream')
+        self.hdf5 = hdf5
+        self.pool = HandlePool(max_open)
         self.nc_parser = NCParser()
+        self.hdf5_parser = HDF5Parser()
+        self.nc_parser.pool = self.hdf5_parser.pool = self.pool
+        self.mainfile_parser = self.nc_parser
         self.calculator_parser = CalculatorParser()
+        self.lazy = lazy
+        self.cache = cache
+        self.share_systems = share_systems
+        self.profiler = Profiler(profile)
+        self.quantities = quantities
+        self._quantities = all_quantities
+        self.incremental = incremental
+        # the parsing state of each file, kept between parses in incremental mode
+        self._increments = dict()
+        self._increment = None
 
         self._metainfo_map = {
             'Exchange-Correlation': 'energy_XC', 'Kinetic': 'electronic_kinetic_energy',
@@ -203,97 +1081,388 @@ class ATKParser(FairdiParser):
             'AM05': ['GGA_X_AM05', 'GGA_C_AM05'],
             'mBEEF': ['MGGA_X_MBEEF', 'GGA_C_PBE_SOL']}
 
+    def is_mainfile(self, filename, mime, buffer, decoded_buffer, compression=None):
+        if not super().is_mainfile(filename, mime, buffer, decoded_buffer, compression):
+            return False
+        # foreign NetCDF and HDF5 files, including NetCDF4 files, are rejected from the
+        # header and root of the file alone
+        if buffer is not None and buffer.startswith(b'\x89HDF'):
+            return self.hdf5 and is_atk_hdf5(filename)
+        return is_atk_netcdf(filename)
+
+    def _new_file_parsers(self):
+        # new file parsers take over the settings of the current ones
+        nc_parser, hdf5_parser = NCParser(), HDF5Parser()
+        for parser, current in [(nc_parser, self.nc_parser), (hdf5_parser, self.hdf5_parser)]:
+            parser.chunk_size = current.chunk_size
+            parser.pool = self.pool
+        self.nc_parser, self.hdf5_parser = nc_parser, hdf5_parser
+        self.mainfile_parser = nc_parser
+
+    def reset(self):
+        '''
+        Closes all files opened by the parser and drops the state of the last parsed file.
+        The deferred sections of lazy iter_sections reopen their file when materialized.
+        '''
+        self.pool.close()
+        # the handles of the last archive still refer to the current file parsers
+        self._new_file_parsers()
+        self.calculator_parser.mainfile = None
+        self.archive = None
+        self._increments = dict()
+        self._increment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
     def init_parser(self):
-        self.nc_parser.mainfile = self.filepath
-        self.nc_parser.logger = self.logger
+        if self.lazy:
+            # the configuration handles of previous archives keep their file parsers,
+            # the pool closes their files and they are reopened when accessed
+            self._new_file_parsers()
+        self.mainfile_parser = self.nc_parser
+        if is_hdf5(self.filepath):
+            if not self.hdf5:
+                self.logger.warning('HDF5 files are only parsed with hdf5 enabled')
+            elif h5py is None:
+                self.logger.warning('h5py is required to parse HDF5 files')
+            else:
+                self.mainfile_parser = self.hdf5_parser
+        for parser in [self.nc_parser, self.hdf5_parser]:
+            parser.mainfile = self.filepath if parser is self.mainfile_parser else None
+        self.mainfile_parser.logger = self.logger
+        self.profiler.reset()
+        self.profiler.start()
+        self.mainfile_parser.profiler = self.profiler
+
+    def parse_configurations(self, configurations):
+        sec_run = self._increment['run']
+        quantities = self._quantities
+
+        def gid(configuration):
+            return configuration.name.rsplit('_', 1)[-1]
 
-    def parse_configurations(self):
-        sec_run = self.archive.section_run[0]
+        # identical calculator data is parsed once and shares the same method section
+        methods = self._increment['methods']
+
+        def defer(section, load):
+            # in lazy mode, load is only run by materialize
+            if self.lazy:
+                section.m_annotations['atk_deferred'] = load
+            else:
+                load()
+
+        def parse_method(configuration):
+            parameters = configuration.parameters
+            digest = hashlib.sha1(parameters).hexdigest() if parameters is not None else None
+            if digest in methods:
+                return methods[digest]
 
-        def parse_method(name):
             sec_method = sec_run.m_create(Method)
+            methods[digest] = sec_method
 
             sec_method.relativity_method = 'pseudo_scalar_relativistic'
             sec_method.electronic_structure_method = 'DFT'
 
             sec_method.smearing_kind = 'fermi'
 
-            parameters = self.nc_parser.get('parameters').get(name)
             if parameters is None:
                 return sec_method
 
-            # this is only a dummy filename as we will get the info from the calculator data
-            self.calculator_parser.mainfile = self.filepath
-            self.calculator_parser._file_handler = parameters
+            filepath = self.filepath
+
+            def load():
+                # this is only a dummy filename as we will get the info from the calculator data
+                self.calculator_parser.mainfile = filepath
+                self.calculator_parser._file_handler = parameters
 
-            for key, val in self.calculator_parser.items():
-                if val is not None:
-                    setattr(sec_method, key, val)
+                with self.profiler.stage('calculator', gid(configuration), len(parameters)):
+                    for key, val in self.calculator_parser.items():
+                        if val is not None:
+                            setattr(sec_method, key, val)
 
-            for xc_functional in self._xc_functional_map.get(self.calculator_parser.get('xc_functional'), []):
-                sec_xc = sec_method.m_create(XCFunctionals)
-                sec_xc.XC_functional_name = xc_functional
+                for xc_functional in self._xc_functional_map.get(self.calculator_parser.get('xc_functional'), []):
+                    sec_xc = sec_method.m_create(XCFunctionals)
+                    sec_xc.XC_functional_name = xc_functional
 
+            defer(sec_method, load)
             return sec_method
 
-        def parse_system(atoms):
-            if atoms is None:
+        # labels, periodicity and cell of the last system which stores them
+        shared = self._increment['shared']
+
+        def load_system(sec_system, configuration):
+            structure = configuration.structure
+            if structure is None:
+                return
+
+            atom_labels = structure.symbols
+            sec_shared = None
+            if self.share_systems:
+                if shared.get('atom_labels') == atom_labels and shared.get('periodic') == configuration.periodic\
+                        and np.array_equal(shared.get('cell'), structure.cell):
+                    sec_shared = shared['system']
+
+            def convert(value, unit, quantity_def):
+                with self.profiler.stage('units', gid(configuration), value.nbytes):
+                    return np.multiply(value, conversion_factor(unit, quantity_def.unit), dtype=np.float64)
+
+            sec_system.atom_positions = convert(structure.positions, ureg.angstrom, System.atom_positions)
+            if sec_shared is None:
+                sec_system.atom_labels = atom_labels
+                sec_system.configuration_periodic_dimensions = [configuration.periodic] * 3
+                cell = structure.cell if structure.cell is not None else np.zeros((3, 3))
+                sec_system.lattice_vectors = convert(cell, ureg.angstrom, System.lattice_vectors)
+                if self.share_systems:
+                    shared.update(
+                        atom_labels=atom_labels, periodic=configuration.periodic, cell=structure.cell,
+                        system=sec_system)
+            else:
+                sec_refs = sec_system.m_create(SystemToSystemRefs)
+                sec_refs.system_to_system_kind = 'species and cell'
+                sec_refs.system_to_system_ref = sec_shared
+            if structure.velocities is not None:
+                sec_system.atom_velocities = convert(
+                    structure.velocities, ureg.angstrom / ureg.fs, System.atom_velocities)
+
+        def parse_system(configuration):
+            # the configuration is not even tokenized in lazy mode
+            if not self.lazy and configuration.structure is None:
                 return
 
             sec_system = sec_run.m_create(System)
-            sec_system.atom_labels = atoms.get_chemical_symbols()
-            sec_system.atom_positions = atoms.get_positions() * ureg.angstrom
-            sec_system.lattice_vectors = atoms.get_cell().array * ureg.angstrom
-            sec_system.configuration_periodic_dimensions = atoms.get_pbc()
-            velocities = atoms.get_velocities()
-            if velocities:
-                sec_system.atom_velocities = velocities * (ureg.angstrom / ureg.fs)
+            if not (self.lazy and self.share_systems):
+                defer(sec_system, lambda: load_system(sec_system, configuration))
+                return sec_system
 
+            # systems are shared in the order they were parsed, whatever the order they are
+            # materialized in, the systems parsed before are thus loaded first
+            pending = shared.setdefault('pending', deque())
+            pending.append((sec_system, configuration))
+
+            def load():
+                while pending:
+                    section, section_configuration = pending.popleft()
+                    section.m_annotations.pop('atk_deferred', None)
+                    load_system(section, section_configuration)
+                    if section is sec_system:
+                        break
+
+            defer(sec_system, load)
             return sec_system
 
-        def parse_scc(fingerprint):
-            sec_scc = sec_run.m_create(SingleConfigurationCalculation)
+        def load_scc(sec_scc, configuration):
+            # forces
+            if 'forces' in quantities and configuration.has_forces:
+                forces = configuration.forces
+                with self.profiler.stage('units', gid(configuration), forces.magnitude.nbytes):
+                    sec_scc.atom_forces = to_magnitude(forces, SingleConfigurationCalculation.atom_forces.unit)
+
+            # band structure and eigenvalues, converted in place segment by segment
+            energy_factor = conversion_factor(ureg.eV, KBandSegment.band_energies.unit)
+            n_spins = 0
+            band_segments = configuration.band_segments if 'band_structure' in quantities else None
+            if band_segments is not None and not sec_scc.section_k_band:
+                sec_k_band = sec_scc.m_create(KBand)
+                sec_k_band.band_structure_kind = 'electronic'
+                for labels, kpoints, band_energies in band_segments:
+                    sec_k_band_segment = sec_k_band.m_create(KBandSegment)
+                    sec_k_band_segment.band_segm_labels = labels
+                    sec_k_band_segment.band_k_points = np.array(kpoints, dtype=np.float64)
+                    sec_k_band_segment.band_segm_start_end = np.array(kpoints[[0, -1]], dtype=np.float64)
+                    sec_k_band_segment.number_of_k_points_per_segment = len(kpoints)
+                    if band_energies is not None:
+                        band_energies *= energy_factor
+                        sec_k_band_segment.band_energies = band_energies
+                        n_spins = len(band_energies)
+
+            eigenvalues = configuration.eigenvalues if 'eigenvalues' in quantities else None
+            if eigenvalues is not None and eigenvalues[1] is not None and not sec_scc.section_eigenvalues:
+                kpoints, values = eigenvalues
+                values *= energy_factor
+                sec_eigenvalues = sec_scc.m_create(Eigenvalues)
+                sec_eigenvalues.eigenvalues_kpoints = np.array(kpoints, dtype=np.float64)
+                sec_eigenvalues.eigenvalues_values = values
+                sec_eigenvalues.number_of_eigenvalues_kpoints = values.shape[1]
+                sec_eigenvalues.number_of_eigenvalues = values.shape[2]
+                n_spins = len(values)
+
+            fermi_level = configuration.fermi_level
+            if fermi_level is not None and n_spins > 0:
+                sec_scc.energy_reference_fermi = [fermi_level * energy_factor] * n_spins
+
+        def parse_scc(configuration, sec_scc=None):
+            if sec_scc is None:
+                sec_scc = sec_run.m_create(SingleConfigurationCalculation)
 
             # energies
-            energy_total = 0.
-            for key, val in self.nc_parser.get('energies').get(fingerprint, {}).items():
-                key = self._metainfo_map.get(key)
-                energy_total += val
-                if key is not None:
-                    setattr(sec_scc, key, val)
-            sec_scc.energy_total = energy_total
+            if 'energies' in quantities:
+                components, energies = configuration.energies
+                energies = energies * conversion_factor(ureg.eV, SingleConfigurationCalculation.energy_total.unit)
+                for key, val in zip(components, energies):
+                    key = self._metainfo_map.get(key)
+                    if key is not None:
+                        setattr(sec_scc, key, val)
+                sec_scc.energy_total = energies.sum()
 
-            # forces
-            forces = self.nc_parser.get('forces').get(fingerprint)
-            if forces is not None:
-                sec_scc.atom_forces = forces
+            # stress
+            stress = configuration.stress if 'stress' in quantities else None
+            if stress is not None:
+                sec_scc.stress_tensor = to_magnitude(stress, SingleConfigurationCalculation.stress_tensor.unit)
 
+            defer(sec_scc, lambda: load_scc(sec_scc, configuration))
             return sec_scc
 
-        for name, atoms in self.nc_parser.get('atoms', {}).items():
-            sec_system = parse_system(atoms)
-            sec_method = parse_method(name)
-            fingerprint = self.nc_parser._fingerprints.get('gID%s' % name.split('gID')[-1])
-            sec_scc = parse_scc(fingerprint)
-            if sec_system is not None:
-                sec_scc.single_configuration_calculation_to_system_ref = sec_system
-            if sec_method is not None:
-                sec_scc.single_configuration_to_calculation_method_ref = sec_method
-
-    def parse(self, filepath, archive, logger):
+        def results(configuration):
+            # the calculation results which are in the file so far
+            return (
+                tuple(configuration.energies[0]), configuration.has_forces, configuration.stress is not None,
+                configuration.band_segments is not None, configuration.fermi_level is not None)
+
+        # the calculations and results of the configurations parsed before
+        emitted = self._increment['emitted']
+
+        for configuration in configurations:
+            if configuration.name in emitted:
+                sec_scc, previous_results = emitted[configuration.name]
+                if sec_scc is None or results(configuration) == previous_results:
+                    continue
+                # results were written after the configuration was parsed
+                with self.profiler.stage('scc', gid(configuration)):
+                    parse_scc(configuration, sec_scc)
+                emitted[configuration.name] = sec_scc, results(configuration)
+                if not self.lazy:
+                    configuration.release()
+                yield sec_scc
+                continue
+
+            sec_system, sec_method, sec_scc = None, None, None
+            if 'system' in quantities:
+                with self.profiler.stage('system', gid(configuration)):
+                    sec_system = parse_system(configuration)
+            n_methods = len(methods)
+            if 'method' in quantities:
+                with self.profiler.stage('method', gid(configuration)):
+                    sec_method = parse_method(configuration)
+            if not quantities.isdisjoint(['energies', 'forces', 'stress', 'band_structure', 'eigenvalues']):
+                with self.profiler.stage('scc', gid(configuration)):
+                    sec_scc = parse_scc(configuration)
+                if sec_system is not None:
+                    sec_scc.single_configuration_calculation_to_system_ref = sec_system
+                if sec_method is not None:
+                    sec_scc.single_configuration_to_calculation_method_ref = sec_method
+            if self.incremental:
+                emitted[configuration.name] = sec_scc, results(configuration)
+            if not self.lazy:
+                # everything is in the archive, no need to keep the decoded configuration
+                configuration.release()
+
+            if len(methods) == n_methods:
+                # the method section was already yielded for a previous configuration
+                sec_method = None
+            for section in [sec_system, sec_method, sec_scc]:
+                if section is not None:
+                    yield section
+
+    def get_configurations(self):
+        '''
+        Returns the program version and the configurations of the file, from the cache
+        if there is an entry for the file and otherwise from the NetCDF or HDF5 file.
+        '''
+        def read():
+            parser = self.mainfile_parser
+            # cache entries always hold all quantities
+            parser.quantities = self._quantities if self.cache is None else None
+            return parser.get('version'), list(parser.get('configurations', {}).values())
+
+        if self.cache is None:
+            return read()
+
+        key = self.cache.key(self.filepath)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        version, configurations = read()
+        if version is None and not configurations:
+            return version, configurations
+
+        # the entry is written while the configurations are parsed to decode the file only once
+        return version, self.cache.write(key, version, configurations, self.logger)
+
+    def iter_sections(self, filepath, archive, logger, quantities=None):
+        '''
+        Parses filepath into archive and yields each section (run, method, system,
+        calculation) as soon as it is populated. The requested quantities default to
+        those of the parser.
+        '''
+        quantities = quantities if quantities is not None else self.quantities
+        quantities = frozenset(quantities) if quantities is not None else all_quantities
+        if not quantities <= all_quantities:
+            raise ValueError('Unknown quantities: %s' % ', '.join(sorted(quantities - all_quantities)))
+        self._quantities = quantities
+
         self.filepath = os.path.abspath(filepath)
         self.archive = archive
         self.logger = logger if logger is not None else logging.getLogger(__name__)
 
+        # a file is parsed incrementally only into the archive it was parsed into before
+        increment = self._increments.get(self.filepath)
+        if increment is None or increment['archive'] is not archive:
+            increment = dict(archive=archive, run=None, methods=dict(), shared=dict(), emitted=dict())
+            if self.incremental:
+                self._increments[self.filepath] = increment
+        self._increment = increment
+
         self.init_parser()
 
-        sec_run = self.archive.m_create(Run)
-        sec_run.program_name = 'ATK'
-        version = self.nc_parser.get('version')
-        sec_run.program_version = version if version is not None else 'unavailable'
-        sec_run.program_basis_set_type = 'numeric AOs'
+        try:
+            version, configurations = self.get_configurations()
+
+            if increment['run'] is None:
+                sec_run = self.archive.m_create(Run)
+                sec_run.program_name = 'ATK'
+                sec_run.program_version = version if version is not None else 'unavailable'
+                sec_run.program_basis_set_type = 'numeric AOs'
+
+                sec_basis = sec_run.m_create(BasisSetAtomCentered)
+                sec_basis.basis_set_atom_centered_short_name = 'ATK LCAO basis'
+                increment['run'] = sec_run
+                yield sec_run
+
+            yield from self.parse_configurations(configurations)
+        finally:
+            self.profiler.stop()
+
+        self.profiler.log(self.logger)
+
+    def parse(self, filepath, archive, logger, quantities=None):
+        for section in self.iter_sections(filepath, archive, logger, quantities):
+            # only the sections of iter_sections are deferred, the archive is complete
+            materialize(section)
 
-        sec_basis = sec_run.m_create(BasisSetAtomCentered)
-        sec_basis.basis_set_atom_centered_short_name = 'ATK LCAO basis'
+    def stream(self, filepath, logger=None):
+        '''
+        Parses filepath and yields a json serializable record for each section as soon
+        as it is populated. All quantities and sub sections of a section are released
+        once its record is consumed, only the empty sections remain in the archive to
+        keep the paths of later records. Memory is thus bounded by a single configuration
+        rather than the whole file.
+        '''
+        archive = EntryArchive()
+        for section in self.iter_sections(filepath, archive, logger):
+            materialize(section)
+            yield dict(
+                section=section.m_parent_sub_section.name, path=section.m_path(),
+                data=section.m_to_dict())
 
-        self.parse_configurations()
+            for quantity_def in section.m_def.all_quantities.values():
+                if quantity_def.derived is None and section.m_is_set(quantity_def):
+                    section.m_set(quantity_def, None)
+            # the sections of later records are only added after this one is released
+            for sub_section_def in section.m_def.all_sub_sections.values():
+                for index in reversed(range(len(section.m_get_sub_sections(sub_section_def)))):
+                    section.m_remove_sub_section(sub_section_def, index)
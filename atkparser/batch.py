@@ -0,0 +1,163 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import json
+import logging
+import tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from nomad.datamodel import EntryArchive
+
+from .atk_parser import ATKParser, read_header, is_hdf5, is_atk_netcdf, is_atk_hdf5, mainfile_name_re,\
+    hdf5_mainfile_name_re
+
+
+# one parser per worker process which is reused for all files of the worker
+_parser = None
+
+
+def _init_worker(**kwargs):
+    global _parser
+    _parser = ATKParser(**kwargs)
+
+
+def _parse(filepath):
+    archive = EntryArchive()
+    try:
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError('No such file')
+        _parser.parse(filepath, archive, logging.getLogger(__name__))
+        if _parser.mainfile_parser is _parser.nc_parser and _parser.nc_parser.netcdf is None:
+            raise ValueError('Not a NetCDF or HDF5 file')
+        return filepath, archive.m_to_dict(), None
+    except Exception as e:
+        return filepath, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def find_mainfiles(paths, hdf5=False):
+    '''
+    Returns the files in paths, directories are searched recursively for files that
+    match the mainfile name pattern of the ATK parser and were written by ATK, with hdf5
+    also for HDF5 files.
+    '''
+    re_mainfile = re.compile(hdf5_mainfile_name_re if hdf5 else mainfile_name_re)
+    mainfiles = []
+    for path in paths:
+        if not os.path.isdir(path):
+            mainfiles.append(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                filename = os.path.join(root, filename)
+                if re_mainfile.fullmatch(filename) is None:
+                    continue
+                # foreign NetCDF and HDF5 files are rejected from their header like in is_mainfile
+                if is_atk_netcdf(filename) or (hdf5 and is_atk_hdf5(filename)):
+                    mainfiles.append(filename)
+
+    return mainfiles
+
+
+def parse_files(paths, workers=None, **kwargs):
+    '''
+    Parses the files and directories in paths in a pool of worker processes, each
+    with its own ATKParser created with kwargs. Results are yielded as soon as they are
+    available as tuples of the file path, the archive as dictionary and an error
+    message. A file which fails to parse does not abort the batch, its archive is None
+    and the error is given instead.
+
+    Arguments:
+        paths: list of files and directories
+        workers: the number of worker processes, defaults to the number of CPUs. With
+            a single worker the files are parsed in the current process.
+    '''
+    mainfiles = find_mainfiles(paths, hdf5=kwargs.get('hdf5', False))
+
+    if workers == 1:
+        _init_worker(**kwargs)
+        for mainfile in mainfiles:
+            yield _parse(mainfile)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(_init_worker, **kwargs)) as executor:
+        futures = [executor.submit(_parse, mainfile) for mainfile in mainfiles]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _stream(filepath):
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError('No such file')
+    # records are emitted right away, the file is thus checked before parsing
+    if read_header(filepath) is None and not is_hdf5(filepath):
+        raise ValueError('Not a NetCDF or HDF5 file')
+    yield from _parser.stream(filepath, logging.getLogger(__name__))
+
+
+def _stream_to_file(filepath, directory):
+    # the records are buffered in a file of directory which is read by the main process
+    fd, path = tempfile.mkstemp(suffix='.jsonl', dir=directory)
+    error = None
+    with os.fdopen(fd, 'w') as f:
+        try:
+            for record in _stream(filepath):
+                f.write(json.dumps(record) + '\n')
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+    return filepath, path, error
+
+
+def stream_files(paths, workers=None, **kwargs):
+    '''
+    Streams the files and directories in paths and yields tuples of the file path, the
+    record of a section and an error message. A file which fails to parse does not abort
+    the batch, a last tuple with no record and the error is yielded for it instead.
+
+    Arguments:
+        paths: list of files and directories
+        workers: the number of worker processes, defaults to the number of CPUs. With
+            a single worker the files are parsed in the current process and each record
+            is yielded as soon as its section is parsed, otherwise the records of a file
+            are yielded once the file is done.
+    '''
+    mainfiles = find_mainfiles(paths, hdf5=kwargs.get('hdf5', False))
+
+    if workers == 1:
+        _init_worker(**kwargs)
+        for mainfile in mainfiles:
+            try:
+                for record in _stream(mainfile):
+                    yield mainfile, record, None
+            except Exception as e:
+                yield mainfile, None, '%s: %s' % (e.__class__.__name__, e)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        with ProcessPoolExecutor(max_workers=workers, initializer=partial(_init_worker, **kwargs)) as executor:
+            futures = [executor.submit(_stream_to_file, mainfile, directory) for mainfile in mainfiles]
+            for future in as_completed(futures):
+                mainfile, path, error = future.result()
+                with open(path) as f:
+                    for line in f:
+                        yield mainfile, json.loads(line), None
+                os.remove(path)
+                if error is not None:
+                    yield mainfile, None, error
@@ -0,0 +1,366 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import hashlib
+import logging
+import tempfile
+import zipfile
+from contextlib import suppress
+import numpy as np
+from ase.data import chemical_symbols
+
+from nomad.units import ureg
+
+from .atk_parser import read_header, is_hdf5, log_warning, Structure
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# has to be increased whenever the format of the decoded results changes
+cache_version = 3
+
+
+class CachedConfiguration:
+    '''
+    Configuration with the same interface as the NetCDF configuration handles which is
+    read from a cache entry. The arrays of the configuration, given by their names in
+    the entry, are loaded when the configuration is created.
+    '''
+    def __init__(self, entry, index, names):
+        prefix = '%d/' % index
+        self._arrays = {name[len(prefix):]: entry[name] for name in names}
+        self.name = str(self._arrays['name'])
+        self.fingerprint = str(self._arrays['fingerprint']) or None
+        self.periodic = bool(self._arrays['periodic'])
+        self._structure = None
+
+    def _get(self, key):
+        return self._arrays.get(key)
+
+    @property
+    def structure(self):
+        if self._structure is None and self._get('numbers') is not None:
+            self._structure = Structure(
+                self._get('numbers'), self._get('positions'), self._get('velocities'),
+                self._get('cell'), bool(self._get('pbc')))
+        return self._structure
+
+    @property
+    def atoms(self):
+        if self.structure is not None:
+            return self.structure.to_atoms()
+
+    @property
+    def atom_labels(self):
+        numbers = self._get('numbers')
+        if numbers is not None:
+            return [chemical_symbols[n] for n in numbers]
+
+    @property
+    def has_velocities(self):
+        return 'velocities' in self._arrays
+
+    @property
+    def parameters(self):
+        parameters = self._get('parameters')
+        if parameters is not None:
+            return parameters.tobytes()
+
+    @property
+    def energies(self):
+        components = self._get('energy_components')
+        if components is None:
+            return [], np.zeros(0)
+        return [str(component) for component in components], self._get('energies')
+
+    @property
+    def has_forces(self):
+        return 'forces' in self._arrays
+
+    @property
+    def forces(self):
+        forces = self._get('forces')
+        if forces is not None:
+            return ureg.Quantity(forces, ureg.eV / ureg.angstrom)
+
+    @property
+    def stress(self):
+        stress = self._get('stress')
+        if stress is not None:
+            return ureg.Quantity(stress, ureg.eV / ureg.angstrom ** 3)
+
+    @property
+    def fermi_level(self):
+        fermi_level = self._get('fermi_level')
+        if fermi_level is not None:
+            return float(fermi_level)
+
+    @property
+    def band_segments(self):
+        n_band_segments = self._get('n_band_segments')
+        if n_band_segments is None:
+            return
+
+        def band_segments():
+            for n in range(int(n_band_segments)):
+                prefix = 'band_segments/%d/' % n
+                yield (
+                    [str(label) for label in self._get(prefix + 'labels')],
+                    self._get(prefix + 'kpoints'), self._get(prefix + 'energies'))
+
+        return band_segments()
+
+    @property
+    def eigenvalues(self):
+        if self._get('eigenvalues_kpoints') is not None:
+            return self._get('eigenvalues_kpoints'), self._get('eigenvalues')
+
+    def release(self):
+        self._structure = None
+
+
+def _read_fingerprint_table(filepath):
+    # the finger print table of a NetCDF file or of the root of an HDF5 file
+    header = read_header(filepath)
+    if header is not None:
+        return header[1].get('fingerprint_table', b'')
+    if h5py is None or not is_hdf5(filepath):
+        return b''
+    try:
+        with h5py.File(filepath, 'r') as f:
+            fingerprint_table = f.attrs.get('fingerprint_table', b'')
+    except Exception:
+        return b''
+    if isinstance(fingerprint_table, str):
+        fingerprint_table = fingerprint_table.encode()
+    return bytes(fingerprint_table)
+
+
+class ResultsCache:
+    '''
+    Persistent on-disk cache for the decoded results of ATK files. Entries are keyed on
+    the size, modification time and finger print table of the file and the cache version.
+    Files without a finger print table are keyed on a hash of their content instead.
+    They are written as numpy npz archives into directory and the least recently used
+    entries are evicted once the total size of the cache exceeds max_size bytes.
+    '''
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filepath):
+        stat = os.stat(filepath)
+        fingerprint_table = _read_fingerprint_table(filepath)
+        key = hashlib.sha1(('%d:%d:%d:' % (cache_version, stat.st_size, stat.st_mtime_ns)).encode())
+        if fingerprint_table:
+            key.update(fingerprint_table)
+        else:
+            # files with the same size and modification time are only told apart by their content
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    key.update(block)
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.npz' % key)
+
+    def _remove(self, path):
+        # the entry might have been replaced or evicted by another process
+        with suppress(OSError):
+            os.remove(path)
+
+    def get(self, key):
+        '''
+        Returns the program version and an iterator over the cached configurations for
+        key or None if there is no such entry. The configurations are loaded one by one
+        and the entry is closed once all of them are read.
+        '''
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return
+
+        try:
+            entry = np.load(path, allow_pickle=False)
+        except Exception:
+            self._remove(path)
+            return
+
+        try:
+            version = str(entry['version']) or None
+            n_configurations = int(entry['n_configurations'])
+            names = [[] for _ in range(n_configurations)]
+            for name in entry.files:
+                index, _, _ = name.partition('/')
+                if index.isdigit():
+                    names[int(index)].append(name)
+        except Exception:
+            entry.close()
+            self._remove(path)
+            return
+
+        # the modification time of the entry marks its last use
+        with suppress(OSError):
+            os.utime(path)
+
+        def configurations():
+            with entry:
+                for index in range(n_configurations):
+                    yield CachedConfiguration(entry, index, names[index])
+
+        return version, configurations()
+
+    def put(self, key, version, configurations):
+        '''
+        Writes the program version and the decoded configurations to the entry for key.
+        The configurations are decoded and written one by one and released afterwards.
+        '''
+        for configuration in self.write(key, version, configurations):
+            configuration.release()
+
+    def write(self, key, version, configurations, logger=None):
+        '''
+        Writes the program version and the configurations to the entry for key and yields
+        each configuration once it is written, the configurations can thus be parsed
+        while the entry is written. If the entry can not be written, the remaining
+        configurations are still yielded and the entry is not added to the cache.
+        '''
+        logger = logger if logger is not None else logging.getLogger(__name__)
+        path = self._path(key)
+        tmp_path = None
+        f = None
+
+        def write(name, value):
+            with f.open('%s.npy' % name, 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asanyarray(value), allow_pickle=False)
+
+        try:
+            try:
+                # each writer has its own temporary file, also threads which write the same entry
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                os.close(fd)
+                f = zipfile.ZipFile(tmp_path, 'w')
+                write('version', np.array(version if version is not None else ''))
+                write('n_configurations', np.array(len(configurations)))
+            except Exception:
+                log_warning(logger, 'Could not write results cache', key=key, exc_info=True)
+                if f is not None:
+                    f.close()
+                    f = None
+
+            for n, configuration in enumerate(configurations):
+                if f is not None:
+                    try:
+                        self._write_configuration(write, '%d/' % n, configuration)
+                    except Exception:
+                        log_warning(logger, 'Could not write results cache', key=key, exc_info=True)
+                        f.close()
+                        f = None
+                yield configuration
+
+            if f is not None:
+                f.close()
+                f = None
+                try:
+                    os.replace(tmp_path, path)
+                except OSError:
+                    log_warning(logger, 'Could not write results cache', key=key, exc_info=True)
+                else:
+                    self.evict()
+        finally:
+            if f is not None:
+                f.close()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                self._remove(tmp_path)
+
+    def _write_configuration(self, write, prefix, configuration):
+        write(prefix + 'name', np.array(configuration.name))
+        write(prefix + 'fingerprint', np.array(configuration.fingerprint or ''))
+        write(prefix + 'periodic', np.array(configuration.periodic))
+
+        structure = configuration.structure
+        if structure is not None:
+            write(prefix + 'numbers', structure.numbers)
+            write(prefix + 'positions', structure.positions)
+            if structure.cell is not None:
+                write(prefix + 'cell', structure.cell)
+            write(prefix + 'pbc', structure.pbc)
+            if structure.velocities is not None:
+                write(prefix + 'velocities', structure.velocities)
+
+        parameters = configuration.parameters
+        if parameters is not None:
+            write(prefix + 'parameters', np.frombuffer(parameters, dtype=np.uint8))
+
+        components, energies = configuration.energies
+        if components:
+            write(prefix + 'energy_components', np.array(components))
+            write(prefix + 'energies', energies)
+
+        forces = configuration.forces
+        if forces is not None:
+            write(prefix + 'forces', forces.to(ureg.eV / ureg.angstrom).magnitude)
+
+        stress = configuration.stress
+        if stress is not None:
+            write(prefix + 'stress', stress.to(ureg.eV / ureg.angstrom ** 3).magnitude)
+
+        fermi_level = configuration.fermi_level
+        if fermi_level is not None:
+            write(prefix + 'fermi_level', np.array(fermi_level))
+
+        band_segments = configuration.band_segments
+        if band_segments is not None:
+            n_band_segments = 0
+            for labels, kpoints, energies in band_segments:
+                segment_prefix = '%sband_segments/%d/' % (prefix, n_band_segments)
+                write(segment_prefix + 'labels', np.array(labels))
+                write(segment_prefix + 'kpoints', kpoints)
+                if energies is not None:
+                    write(segment_prefix + 'energies', energies)
+                n_band_segments += 1
+            write(prefix + 'n_band_segments', np.array(n_band_segments))
+
+        eigenvalues = configuration.eigenvalues
+        if eigenvalues is not None and eigenvalues[1] is not None:
+            write(prefix + 'eigenvalues_kpoints', eigenvalues[0])
+            write(prefix + 'eigenvalues', eigenvalues[1])
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits into max_size.
+        '''
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, filename))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, filename in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(os.path.join(self.directory, filename))
+            size -= entry_size
@@ -0,0 +1,136 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+import logging
+import tracemalloc
+from contextlib import nullcontext
+
+
+_disabled = nullcontext()
+
+
+class Stage:
+    '''
+    Context manager which measures a single run of a stage of the profiler.
+    '''
+    def __init__(self, profiler, name, gid, nbytes):
+        self.profiler = profiler
+        self.name = name
+        self.gid = gid
+        self.nbytes = nbytes
+        self.peak = 0
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        self.memory = tracemalloc.get_traced_memory()[0] if self.tracing else 0
+        self.profiler._stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.profiler._stack.pop()
+        if self.tracing and tracemalloc.is_tracing():
+            if hasattr(tracemalloc, 'reset_peak'):
+                # the peak is reset for each stage, the enclosing stages keep track of it
+                traced = tracemalloc.get_traced_memory()[1]
+                tracemalloc.reset_peak()
+            else:
+                # without reset_peak (python < 3.9) only the memory still allocated at
+                # the end of the stage is known
+                traced = tracemalloc.get_traced_memory()[0]
+            for stage in self.profiler._stack + [self]:
+                stage.peak = max(stage.peak, traced - stage.memory)
+        self.profiler._record(self, elapsed)
+
+
+class Profiler:
+    '''
+    Records the wall time, number of calls, decoded bytes and the peak of allocated memory
+    of the stages of the parsers, in total and per gID. A disabled profiler does not
+    measure anything and its stages are no-ops. Allocations are only traced between start
+    and stop. Before python 3.9, the peak of a stage is the memory it still holds at its
+    end rather than the true peak.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._tracing = False
+        self.reset()
+
+    def reset(self):
+        self.stages = dict()
+        self.gids = dict()
+        self._stack = []
+
+    def start(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    def stop(self):
+        # only stop tracing allocations if it was started by the profiler
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def stage(self, name, gid=None, nbytes=0):
+        '''
+        Returns a context manager that measures the enclosed code as a run of the stage
+        with name for gid, nbytes is the number of bytes decoded by the stage.
+        '''
+        if not self.enabled:
+            return _disabled
+        return Stage(self, name, gid, nbytes)
+
+    def _record(self, stage, elapsed):
+        records = [self.stages]
+        if stage.gid is not None:
+            records.append(self.gids.setdefault(stage.gid, dict()))
+        for record in records:
+            record = record.setdefault(stage.name, dict(time=0., calls=0, bytes=0, peak=0))
+            record['time'] += elapsed
+            record['calls'] += 1
+            record['bytes'] += stage.nbytes
+            record['peak'] = max(record['peak'], stage.peak)
+
+    @property
+    def stats(self):
+        '''
+        The recorded stages as dictionary with the totals under stages and the stages of
+        each gID under gids.
+        '''
+        return dict(stages=self.stages, gids=self.gids)
+
+    def log(self, logger):
+        '''
+        Emits one structured event for the totals of each stage and one for each gID.
+        '''
+        if not self.enabled:
+            return
+
+        def info(event, **kwargs):
+            if isinstance(logger, logging.Logger):
+                logger.info(event, extra=kwargs)
+            else:
+                logger.info(event, **kwargs)
+
+        for name, record in self.stages.items():
+            info('parser stage', stage=name, **record)
+        for gid, stages in self.gids.items():
+            info('parser gid stages', gid=gid, stages=stages)
@@ -27,7 +27,8 @@ def main():
         author='The NOMAD Authors',
         license='APACHE 2.0',
         packages=find_packages(exclude=['tests']),
-        install_requires=['nomad-lab'])
+        install_requires=['nomad-lab'],
+        extras_require={'hdf5': ['h5py']})
 
 
 if __name__ == '__main__':
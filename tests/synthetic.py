@@ -0,0 +1,203 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Writes synthetic ATK-style NetCDF and QuantumATK-style HDF5 files for tests and benchmarks.
+'''
+
+import numpy as np
+from ase.lattice import FCC
+from scipy.io import netcdf_file
+
+
+energy_components = ['Kinetic', 'Exchange-Correlation', 'Electrostatic', 'Entropy-Term']
+
+calculator_text = '''exchange_correlation = LDA.PZ
+
+numerical_accuracy_parameters = NumericalAccuracyParameters(
+    electron_temperature=300.0*Kelvin,
+    )
+'''
+
+
+def _array_text(values):
+    return '[%s]' % ',\n'.join(['[ %.8f, %.8f, %.8f]' % tuple(v) for v in values])
+
+
+def configuration_text(positions, lattice_constant=5.4306, velocities=None, molecule=False):
+    elements = ', '.join(['Silicon'] * len(positions))
+    velocities = '' if velocities is None else '''
+# Define velocities
+velocities = %s*Angstrom/fs
+''' % _array_text(velocities)
+    if molecule:
+        return '''# Define elements
+elements = [%s]
+
+# Define coordinates
+cartesian_coordinates = %s*Angstrom
+%s
+# Set up configuration
+molecule_configuration = MoleculeConfiguration(
+    elements=elements,
+    cartesian_coordinates=cartesian_coordinates
+    )
+''' % (elements, _array_text(positions), velocities)
+
+    return '''# Set up lattice
+lattice = FaceCenteredCubic(%f*Angstrom)
+
+# Define elements
+elements = [%s]
+
+# Define coordinates
+fractional_coordinates = %s
+%s
+# Set up configuration
+bulk_configuration = BulkConfiguration(
+    bravais_lattice=lattice,
+    elements=elements,
+    fractional_coordinates=fractional_coordinates
+    )
+''' % (lattice_constant, elements, _array_text(positions), velocities)
+
+
+def _write_text(nc, name, text):
+    data = np.frombuffer(text.encode(), dtype='S1')
+    nc.createDimension('%s_dim' % name, len(data))
+    nc.createVariable(name, 'c', ('%s_dim' % name,))[:] = data
+
+
+def write_netcdf(
+        filename, n_configurations=1, n_atoms=2, seed=0, velocities=False, forces=True,
+        calculator=True, molecule=False, stress=False, eigenvalues=None):
+    '''
+    Writes a file with n_configurations silicon configurations, each with total energy
+    components and optionally velocities, a calculator, a forces and a stress result and
+    an eigenvalues result with eigenvalues=(n_kpoints, n_bands). The
+    configurations are bulk fcc configurations in fractional coordinates or, with molecule,
+    molecule configurations in cartesian coordinates. The finger prints of the
+    configurations depend on seed.
+    '''
+    rng = np.random.default_rng(seed)
+    nc = netcdf_file(filename, 'w')
+    nc.version = 'ATK 2016.0.3'
+    nc.createDimension('float', 1)
+    nc.createDimension('3D', 3)
+    nc.createDimension('n_atoms', n_atoms)
+
+    configuration = 'MoleculeConfiguration' if molecule else 'BulkConfiguration'
+    fingerprints = []
+    for n in range(n_configurations):
+        gid, energy_gid, forces_gid = ['gID%03d' % (3 * n + i) for i in range(3)]
+        fingerprint = '%023d' % (n + seed * n_configurations)
+        fingerprints.append('%s:%s#' % (fingerprint, gid))
+
+        positions = rng.random((n_atoms, 3)) * (10 if molecule else 1)
+        _write_text(nc, '%s_%s' % (configuration, gid), configuration_text(
+            positions, velocities=rng.random((n_atoms, 3)) if velocities else None, molecule=molecule))
+        if calculator:
+            _write_text(nc, '%s_%s_calculator' % (configuration, gid), calculator_text)
+        _write_text(nc, 'TotalEnergy_%s_finger_print' % energy_gid, fingerprint)
+        for component in energy_components:
+            variable = nc.createVariable(
+                'TotalEnergy_%s_component_%s' % (energy_gid, component), 'd', ('float',))
+            variable[:] = rng.random(1)
+            variable.unit = 'eV'
+        if forces:
+            _write_text(nc, 'Forces_%s_finger_print' % forces_gid, fingerprint)
+            nc.createVariable(
+                'Forces_%s_atom_resolved_forces' % forces_gid, 'd', ('n_atoms', '3D'))[:] = rng.random((n_atoms, 3))
+        # further results are numbered after the configurations to keep their gIDs
+        stress_gid, eigenvalues_gid = ['gID%03d' % (3 * n_configurations + 2 * n + i) for i in range(2)]
+        if stress:
+            _write_text(nc, 'Stress_%s_finger_print' % stress_gid, fingerprint)
+            nc.createVariable('Stress_%s_stress' % stress_gid, 'd', ('3D', '3D'))[:] = np.diag(rng.random(3))
+        if eigenvalues is not None:
+            n_kpoints, n_bands = eigenvalues
+            if n == 0:
+                nc.createDimension('n_kpoints', n_kpoints)
+                nc.createDimension('n_bands', n_bands)
+            _write_text(nc, 'Eigenvalues_%s_finger_print' % eigenvalues_gid, fingerprint)
+            nc.createVariable('Eigenvalues_%s_kpoints' % eigenvalues_gid, 'd', ('n_kpoints', '3D'))[:] = rng.random(
+                (n_kpoints, 3))
+            nc.createVariable('Eigenvalues_%s_eigenvalues_up' % eigenvalues_gid, 'd', ('n_kpoints', 'n_bands'))[:] = \
+                np.sort(rng.random((n_kpoints, n_bands)), axis=1)
+            variable = nc.createVariable('Eigenvalues_%s_fermi_level' % eigenvalues_gid, 'd', ('float',))
+            variable[:] = 0.5
+            variable.unit = 'eV'
+
+    nc.fingerprint_table = ''.join(fingerprints)
+    nc.close()
+
+
+def write_foreign_netcdf(filename):
+    '''
+    Writes a NetCDF file which was not written by ATK.
+    '''
+    nc = netcdf_file(filename, 'w')
+    nc.version = '1.0'
+    nc.createDimension('time', 3)
+    nc.createVariable('temperature', 'd', ('time',))[:] = np.arange(3.)
+    nc.close()
+
+
+def write_hdf5(
+        filename, n_configurations=1, n_atoms=2, seed=0, velocities=False, forces=True,
+        calculator=True, molecule=False, lattice_constant=5.4306):
+    '''
+    Writes a QuantumATK-style HDF5 file with the same data as write_netcdf for the
+    same arguments. Numeric datasets are chunked and stored big-endian.
+    '''
+    import h5py
+
+    rng = np.random.default_rng(seed)
+    cell = FCC(lattice_constant).tocell()[:]
+    chunks = (max(1, min(n_atoms, 1024)), 3)
+    configuration = 'MoleculeConfiguration' if molecule else 'BulkConfiguration'
+    with h5py.File(filename, 'w') as f:
+        f.attrs['version'] = 'ATK 2016.0.3'
+        fingerprints = []
+        for n in range(n_configurations):
+            gid, energy_gid, forces_gid = ['gID%03d' % (3 * n + i) for i in range(3)]
+            fingerprint = '%023d' % (n + seed * n_configurations)
+            fingerprints.append('%s:%s#' % (fingerprint, gid))
+
+            group = f.create_group('%s_%s' % (configuration, gid))
+            group['elements'] = np.full(n_atoms, 14)
+            positions = rng.random((n_atoms, 3)) * (10 if molecule else 1)
+            if not molecule:
+                positions = positions @ cell
+                group.create_dataset('primitive_vectors', data=cell.astype('>f8'))
+            group.create_dataset('cartesian_coordinates', data=positions.astype('>f8'), chunks=chunks)
+            if velocities:
+                group.create_dataset('velocities', data=rng.random((n_atoms, 3)).astype('>f8'), chunks=chunks)
+            if calculator:
+                group['calculator'] = np.bytes_(calculator_text)
+
+            group = f.create_group('TotalEnergy_%s' % energy_gid)
+            group.attrs['finger_print'] = fingerprint
+            for component in energy_components:
+                group['component_%s' % component] = rng.random(1)[0]
+            if forces:
+                group = f.create_group('Forces_%s' % forces_gid)
+                group.attrs['finger_print'] = fingerprint
+                group.create_dataset(
+                    'atom_resolved_forces', data=rng.random((n_atoms, 3)).astype('>f8'), chunks=chunks)
+
+        f.attrs['fingerprint_table'] = ''.join(fingerprints)
@@ -0,0 +1,124 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+import asyncio
+import shutil
+import threading
+import pytest
+
+from nomad.datamodel import EntryArchive
+from atkparser import aio
+from atkparser.aio import AsyncParser
+from synthetic import write_netcdf, write_foreign_netcdf
+
+
+def test_parse():
+    async def parse():
+        async with AsyncParser() as parser:
+            return await parser.parse('tests/data/Si2.nc')
+
+    archive = asyncio.run(parse())
+    assert archive.section_run[0].program_version == 'ATK 2016.0.3'
+    assert len(archive.section_run[0].section_single_configuration_calculation) == 1
+
+
+def test_parse_files(tmp_path, monkeypatch):
+    for n in range(4):
+        write_netcdf(str(tmp_path / ('synthetic_%d.nc' % n)), n_configurations=n + 1)
+    shutil.copy('tests/data/Si2.nc', str(tmp_path / 'Si2.nc'))
+    with open(str(tmp_path / 'broken.nc'), 'w') as f:
+        f.write('not a netcdf file')
+    # broken files are only parsed when given explicitly, foreign files in directories are skipped
+    write_foreign_netcdf(str(tmp_path / 'foreign.nc'))
+
+    open_files = dict(current=0, max=0)
+    lock = threading.Lock()
+
+    class CountingParser(AsyncParser):
+        def _parse(self, *args):
+            with lock:
+                open_files['current'] += 1
+                open_files['max'] = max(open_files['max'], open_files['current'])
+            try:
+                time.sleep(0.05)
+                return super()._parse(*args)
+            finally:
+                with lock:
+                    open_files['current'] -= 1
+
+    # the directories are searched and the archives serialized outside of the event loop
+    blocking_threads = set()
+
+    def record_thread(function):
+        def wrapper(*args, **kwargs):
+            blocking_threads.add(threading.current_thread())
+            return function(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(EntryArchive, 'm_to_dict', record_thread(EntryArchive.m_to_dict))
+    monkeypatch.setattr(aio, 'find_mainfiles', record_thread(aio.find_mainfiles))
+
+    async def parse_files():
+        async with CountingParser(max_workers=4, max_open=2) as parser:
+            return {
+                os.path.basename(filepath): (archive, error)
+                async for filepath, archive, error in parser.parse_files(
+                    [str(tmp_path), str(tmp_path / 'broken.nc')])}
+
+    results = asyncio.run(parse_files())
+    assert len(results) == 6
+    assert 'foreign.nc' not in results
+    assert 'NetCDF' in results['broken.nc'][1]
+    archive, error = results['synthetic_3.nc']
+    assert error is None
+    assert len(archive['section_run'][0]['section_single_configuration_calculation']) == 4
+    assert open_files['max'] == 2
+    assert blocking_threads and threading.main_thread() not in blocking_threads
+
+
+def test_cancel(tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    n_configurations = 1000
+    write_netcdf(filename, n_configurations=n_configurations, n_atoms=200)
+
+    def n_calculations(archive):
+        return len(archive.section_run[0].section_single_configuration_calculation) if archive.section_run else 0
+
+    async def parse(cancel):
+        async with AsyncParser(max_workers=1) as parser:
+            archive = EntryArchive()
+            if cancel:
+                task = asyncio.ensure_future(parser.parse(filename, archive))
+                while n_calculations(archive) == 0:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+                assert n_calculations(archive) > 0
+            else:
+                with pytest.raises(asyncio.TimeoutError):
+                    await parser.parse(filename, archive, timeout=0.1)
+            # the worker has stopped and the file slot is free again
+            assert parser._open_files._value == parser.max_open
+            return archive
+
+    for cancel in [False, True]:
+        archive = asyncio.run(parse(cancel))
+        assert n_calculations(archive) < n_configurations
@@ -16,10 +16,27 @@
 # limitations under the License.
 #
 
+import os
+import sys
+import json
+import logging
+import subprocess
+import tracemalloc
+import numpy as np
 import pytest
+from scipy.io import netcdf_file
 
 from nomad.datamodel import EntryArchive
 from atkparser import ATKParser
+from atkparser.atk_parser import NCParser, HDF5Parser, materialize, is_deferred
+from synthetic import write_netcdf, write_hdf5
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+requires_h5py = pytest.mark.skipif(h5py is None, reason='h5py is not installed')
 
 
 def approx(value, abs=0, rel=1e-6):
@@ -50,3 +67,484 @@ def test_scf(parser):
     sec_scc = sec_run.section_single_configuration_calculation[0]
     assert sec_scc.energy_total.magnitude == approx(-5.73249938e-17)
     assert sec_scc.energy_XC.magnitude == approx(-3.41975673e-17)
+    assert sec_scc.stress_tensor[0][0].magnitude == approx(1.14363600e+09)
+    assert sec_scc.energy_reference_fermi[0].magnitude == approx(-6.55823204e-19)
+
+    sec_k_band_segments = sec_scc.section_k_band[0].section_k_band_segment
+    assert len(sec_k_band_segments) == 10
+    assert sec_k_band_segments[1].band_segm_labels == ['X', 'W']
+    assert sec_k_band_segments[1].band_k_points[-1] == approx([0.5, 0.25, 0.75])
+    assert sec_k_band_segments[0].band_energies.shape == (1, 21, 26)
+    assert sec_k_band_segments[0].band_energies[0][0][0].magnitude == approx(-2.59351574e-18)
+
+
+def test_lazy():
+    archive = EntryArchive()
+    for _ in ATKParser(lazy=True).iter_sections('tests/data/Si2.nc', archive, None):
+        pass
+
+    sec_run = archive.section_run[0]
+    assert sec_run.program_version == 'ATK 2016.0.3'
+
+    sec_scc = sec_run.section_single_configuration_calculation[0]
+    assert sec_scc.energy_total.magnitude == approx(-5.73249938e-17)
+
+    sec_system = sec_run.section_system[0]
+    assert is_deferred(sec_system) and is_deferred(sec_scc)
+    assert not is_deferred(sec_run)
+    assert sec_system.atom_positions is None
+    assert sec_run.section_method[0].smearing_width is None
+    assert archive.m_xpath('section_run[0].section_system[0].atom_positions') is None
+
+    materialize(sec_system)
+    assert not is_deferred(sec_system) and is_deferred(sec_scc)
+    assert sec_system.atom_labels == ['Si', 'Si']
+    assert sec_system.atom_positions[1][0].magnitude == approx(1.35765e-10)
+    assert sec_scc.atom_forces is None
+
+    materialize(archive)
+    assert archive.m_xpath('section_run[0].section_system[0].atom_positions')[1][0] == approx(1.35765e-10)
+    assert archive.m_to_dict()['section_run'][0]['section_system'][0]['lattice_vectors'][1][0] == approx(2.7153e-10)
+    assert sec_run.section_method[0].smearing_width is not None
+    assert len(sec_scc.section_k_band[0].section_k_band_segment) == 10
+
+    # the archives of parse are complete
+    archive = EntryArchive()
+    ATKParser(lazy=True).parse('tests/data/Si2.nc', archive, None)
+    assert not any(is_deferred(section) for section in archive.m_all_contents())
+    assert archive.section_run[0].section_system[0].atom_positions is not None
+
+
+def test_stream(parser):
+    records = list(parser.stream('tests/data/Si2.nc'))
+
+    assert [record['section'] for record in records] == [
+        'section_run', 'section_system', 'section_method',
+        'section_single_configuration_calculation']
+    assert records[0]['data']['program_version'] == 'ATK 2016.0.3'
+    assert records[1]['data']['atom_labels'] == ['Si', 'Si']
+    sec_scc = records[3]['data']
+    assert sec_scc['single_configuration_calculation_to_system_ref'] == records[1]['path']
+    assert sec_scc['energy_total'] == approx(-5.73249938e-17)
+
+
+def test_stream_release(tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=3)
+    parser = ATKParser(lazy=True)
+    records = list(parser.stream(filename))
+
+    assert [record['path'] for record in records if record['section'] == 'section_system'] == [
+        '/section_run/0/section_system/%d' % n for n in range(3)]
+    assert records[-1]['data']['atom_forces'] is not None
+    # only the empty sections of the emitted records are left
+    sec_run = parser.archive.section_run[0]
+    assert len(sec_run.section_system) == 3
+    for section in [sec_run] + list(sec_run.m_all_contents()):
+        assert not any(section.m_is_set(quantity_def) for quantity_def in section.m_def.all_quantities.values())
+    assert len(sec_run.section_basis_set_atom_centered) == 0
+
+
+def test_shared_method(parser, tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=3)
+    archive = EntryArchive()
+    parser.parse(filename, archive, None)
+
+    sec_run = archive.section_run[0]
+    assert len(sec_run.section_method) == 1
+    for sec_scc in sec_run.section_single_configuration_calculation:
+        assert sec_scc.single_configuration_to_calculation_method_ref == sec_run.section_method[0]
+
+    records = list(parser.stream(filename))
+    assert [record['section'] for record in records].count('section_method') == 1
+
+
+def test_share_systems(tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=20, n_atoms=2)
+    archives = []
+    for share_systems in [False, True]:
+        archive = EntryArchive()
+        ATKParser(share_systems=share_systems).parse(filename, archive, None)
+        archives.append(archive)
+
+    sec_systems = archives[1].section_run[0].section_system
+    assert len(sec_systems) == 20
+    assert sec_systems[0].atom_labels == ['Si', 'Si']
+    for sec_system in sec_systems[1:]:
+        assert sec_system.atom_labels is None
+        assert sec_system.lattice_vectors is None
+        assert sec_system.section_system_to_system_refs[0].system_to_system_ref == sec_systems[0]
+    reference = archives[0].section_run[0].section_system
+    assert sec_systems[-1].atom_positions.magnitude == approx(reference[-1].atom_positions.magnitude)
+
+    # lazy systems are shared in the order they were parsed, whatever the order they are materialized in
+    archive = EntryArchive()
+    for _ in ATKParser(lazy=True, share_systems=True).iter_sections(filename, archive, None):
+        pass
+    sec_systems = archive.section_run[0].section_system
+    materialize(sec_systems[2])
+    assert not any(is_deferred(sec_system) for sec_system in sec_systems[:3])
+    assert is_deferred(sec_systems[3])
+    materialize(sec_systems[0])
+    materialize(archive)
+    assert sec_systems[0].atom_labels == ['Si', 'Si']
+    for sec_system in sec_systems[1:]:
+        assert sec_system.atom_labels is None
+        assert sec_system.section_system_to_system_refs[0].system_to_system_ref == sec_systems[0]
+    assert sec_systems[-1].atom_positions.magnitude == approx(reference[-1].atom_positions.magnitude)
+
+    sizes = [len(json.dumps(archive.m_to_dict()['section_run'][0]['section_system'])) for archive in archives]
+    print('systems size: %d shared: %d' % tuple(sizes))
+    assert sizes[1] < 0.9 * sizes[0]
+
+
+def test_profile(tmp_path, caplog):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=3, n_atoms=4)
+
+    parser = ATKParser()
+    parser.parse(filename, EntryArchive(), None)
+    assert parser.profiler.stats == dict(stages=dict(), gids=dict())
+
+    parser = ATKParser(profile=True)
+    with caplog.at_level(logging.INFO):
+        parser.parse(filename, EntryArchive(), logging.getLogger('atkparser'))
+    stats = parser.profiler.stats
+    for stage in ['open', 'configurations', 'configuration', 'calculator', 'units', 'system', 'method', 'scc']:
+        assert stats['stages'][stage]['time'] > 0
+    assert stats['stages']['system']['calls'] == 3
+    assert stats['stages']['calculator']['calls'] == 1
+    assert stats['stages']['configuration']['peak'] > 0
+    assert sorted(stats['gids']) == ['gID000', 'gID003', 'gID006']
+    assert stats['gids']['gID003']['configuration']['bytes'] > 0
+    # positions, lattice vectors and forces
+    assert stats['gids']['gID003']['units']['bytes'] == (4 + 3 + 4) * 3 * 8
+
+    events = [record for record in caplog.records if record.msg == 'parser stage']
+    assert {record.stage for record in events} == set(stats['stages'])
+
+
+def test_profile_without_reset_peak(tmp_path, monkeypatch):
+    # python < 3.9 has no tracemalloc.reset_peak
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=3, n_atoms=4)
+
+    parser = ATKParser(profile=True)
+    parser.parse(filename, EntryArchive(), None)
+    stats = parser.profiler.stats
+    assert stats['stages']['configuration']['calls'] == 3
+    assert stats['stages']['configuration']['peak'] > 0
+
+
+@requires_h5py
+@pytest.mark.parametrize('kwargs', [dict(velocities=True), dict(molecule=True, calculator=False)])
+def test_hdf5(tmp_path, kwargs):
+    archives = []
+    for write, filename in [(write_netcdf, 'trajectory.nc'), (write_hdf5, 'trajectory.hdf5')]:
+        filename = str(tmp_path / filename)
+        write(filename, n_configurations=3, n_atoms=5, **kwargs)
+        archive = EntryArchive()
+        ATKParser(hdf5=True).parse(filename, archive, None)
+        archives.append(archive.m_to_dict()['section_run'][0])
+
+    reference, sec_run = archives
+    assert sec_run['program_version'] == 'ATK 2016.0.3'
+    assert len(sec_run['section_method']) == len(reference['section_method'])
+    for key in ['section_system', 'section_single_configuration_calculation']:
+        assert len(sec_run[key]) == 3
+        for section, reference_section in zip(sec_run[key], reference[key]):
+            assert section.keys() == reference_section.keys()
+            for name, value in reference_section.items():
+                if isinstance(value, (list, float)) and name != 'atom_labels':
+                    assert np.array(section[name]) == approx(np.array(value))
+                else:
+                    assert section[name] == value
+
+    # HDF5 files are only parsed with hdf5
+    archive = EntryArchive()
+    ATKParser().parse(filename, archive, None)
+    assert archive.section_run[0].program_version == 'unavailable'
+
+
+def test_without_h5py(tmp_path):
+    filename = str(tmp_path / 'trajectory.hdf5')
+    if h5py is not None:
+        write_hdf5(filename)
+    code = '''
+import sys
+sys.modules['h5py'] = None
+from nomad.datamodel import EntryArchive
+from atkparser import ATKParser
+for filename in sys.argv[1:]:
+    archive = EntryArchive()
+    ATKParser(hdf5=True).parse(filename, archive, None)
+    print(archive.section_run[0].program_version)
+'''
+    filenames = ['tests/data/Si2.nc'] + ([filename] if h5py is not None else [])
+    result = subprocess.run(
+        [sys.executable, '-c', code] + filenames, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr.decode()
+    # HDF5 files are not parsed without h5py
+    assert result.stdout.decode().split('\n')[:len(filenames)] == ['ATK 2016.0.3', 'unavailable'][:len(filenames)]
+
+
+@requires_h5py
+def test_hdf5_chunks(tmp_path):
+    filename = str(tmp_path / 'large.h5')
+    write_hdf5(filename, n_atoms=1000, velocities=True)
+    parser = HDF5Parser(chunk_size=1000)
+    parser.mainfile = filename
+    configuration = parser.get('configurations')['BulkConfiguration_gID000']
+    with h5py.File(filename, 'r') as f:
+        assert np.array_equal(configuration.forces.magnitude, f['Forces_gID002/atom_resolved_forces'][()])
+        assert np.array_equal(configuration.structure.velocities, f['BulkConfiguration_gID000/velocities'][()])
+    assert configuration.forces.magnitude.dtype == np.float64
+
+
+def test_stacked_energies():
+    nc_parser = NCParser()
+    nc_parser.mainfile = 'tests/data/Si2.nc'
+    (components, energies), = nc_parser.get('energies').values()
+    assert energies.dtype == np.float64 and energies.shape == (len(components),)
+    assert energies.sum() * 1.602176634e-19 == approx(-5.73249938e-17)
+    assert energies[components.index('Exchange-Correlation')] * 1.602176634e-19 == approx(-3.41975673e-17)
+
+
+def test_trajectory(tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=4, n_atoms=6, velocities=True)
+    nc_parser = NCParser()
+    nc_parser.mainfile = filename
+
+    trajectory = nc_parser.get('trajectory')
+    assert trajectory['gids'] == ['gID000', 'gID003', 'gID006', 'gID009']
+    assert trajectory['fingerprints'][1] == '%023d' % 1
+    for key in ['positions', 'velocities', 'forces']:
+        assert trajectory[key].shape == (4, 6, 3)
+        assert trajectory[key].flags.c_contiguous
+    assert trajectory['cells'].shape == (4, 3, 3)
+
+    structures = nc_parser.get('structures')
+    forces = nc_parser.get('forces')
+    for frame, name in enumerate(trajectory['names']):
+        assert trajectory['positions'][frame] == approx(structures[name].positions)
+        assert trajectory['velocities'][frame] == approx(structures[name].velocities)
+        assert trajectory['cells'][frame] == approx(structures[name].cell)
+        assert trajectory['forces'][frame] == approx(forces[trajectory['fingerprints'][frame]].magnitude)
+
+
+def test_structure():
+    nc_parser = NCParser()
+    nc_parser.mainfile = 'tests/data/Si2.nc'
+    structure, = nc_parser.get('structures').values()
+    assert structure.symbols == ['Si', 'Si']
+    assert structure.pbc
+    assert structure.positions[1][0] == approx(1.35765)
+    assert structure.cell[1][0] == approx(2.7153)
+
+    atoms, = nc_parser.get('atoms').values()
+    assert atoms.get_chemical_symbols() == structure.symbols
+    assert atoms.positions == approx(structure.positions)
+    assert atoms.cell.array == approx(structure.cell)
+
+
+def test_is_mainfile(parser, tmp_path):
+    foreign = str(tmp_path / 'foreign.nc')
+    with netcdf_file(foreign, 'w') as f:
+        f.version = '1.0'
+        f.createDimension('time', 3)
+        f.createVariable('temperature', 'd', ('time',))[:] = np.arange(3.)
+    variables = str(tmp_path / 'variables.nc')
+    with netcdf_file(variables, 'w', version=2) as f:
+        f.fingerprint_table = '0:gID000#'
+        f.createDimension('n', 3)
+        f.createVariable('BulkConfiguration_gID000', 'c', ('n',))[:] = np.frombuffer(b'abc', dtype='S1')
+
+    def is_mainfile(filename, parser=parser):
+        with open(filename, 'rb') as f:
+            buffer = f.read(2048)
+        return parser.is_mainfile(filename, 'application/octet-stream', buffer, None)
+
+    assert is_mainfile('tests/data/Si2.nc')
+    assert is_mainfile(variables)
+    assert not is_mainfile(foreign)
+    assert not is_mainfile('README.md')
+    if h5py is not None:
+        hdf5_parser = ATKParser(hdf5=True)
+        hdf5 = str(tmp_path / 'trajectory.hdf5')
+        write_hdf5(hdf5)
+        # HDF5 files are only matched with hdf5
+        assert not is_mainfile(hdf5)
+        assert is_mainfile(hdf5, hdf5_parser)
+        renamed = str(tmp_path / 'trajectory4.nc')
+        os.rename(hdf5, renamed)
+        assert not is_mainfile(renamed)
+        assert is_mainfile(renamed, hdf5_parser)
+        # NetCDF4 files are HDF5 files underneath
+        foreign_hdf5 = str(tmp_path / 'foreign4.nc')
+        with h5py.File(foreign_hdf5, 'w') as f:
+            f.attrs['title'] = 'foreign'
+            f.create_dataset('temperature', data=np.arange(3.))
+        assert not is_mainfile(foreign_hdf5, hdf5_parser)
+        with h5py.File(foreign_hdf5, 'a') as f:
+            f.attrs['version'] = '1.0'
+            f.create_dataset('BulkConfiguration_gID000', data=np.arange(3.))
+        assert not is_mainfile(foreign_hdf5, hdf5_parser)
+
+
+def test_eigenvalues(tmp_path):
+    filename = str(tmp_path / 'eigenvalues.nc')
+    write_netcdf(filename, n_configurations=2, stress=True, eigenvalues=(50, 8))
+    nc_parser = NCParser()
+    # a few k-points per chunk
+    nc_parser.chunk_size = 100
+    nc_parser.mainfile = filename
+    with netcdf_file(filename, 'r', mmap=False) as f:
+        reference = f.variables['Eigenvalues_gID007_eigenvalues_up'].data + 0.5
+    kpoints, eigenvalues = nc_parser.get('eigenvalues')['%023d' % 0]
+    assert eigenvalues.shape == (1, 50, 8)
+    assert eigenvalues[0] == approx(reference)
+
+    archive = EntryArchive()
+    ATKParser().parse(filename, archive, None)
+    sec_scc = archive.section_run[0].section_single_configuration_calculation[0]
+    assert sec_scc.section_eigenvalues[0].eigenvalues_values.magnitude[0] == approx(reference * 1.602176634e-19)
+    assert sec_scc.section_eigenvalues[0].number_of_eigenvalues == 8
+    assert sec_scc.stress_tensor.shape == (3, 3)
+
+
+def test_band_segments(caplog):
+    nc_parser = NCParser()
+    nc_parser.mainfile = 'tests/data/Si2.nc'
+    assert nc_parser.netcdf is not None
+    variables = list(nc_parser._get_result_names('bandstructure').values())[0]
+    assert len(list(nc_parser._resolve_band_segments(variables))) == 10
+    # missing symmetry points skip the band structure instead of failing the parse
+    for key in ['keys_symmetry_points', 'values_symmetry_points']:
+        partial = {k: v for k, v in variables.items() if k != key}
+        assert list(nc_parser._resolve_band_segments(partial)) == []
+
+    read_text = nc_parser._read_text
+    route = read_text(variables['route']).split(',')
+    nc_parser._read_text = lambda name: (
+        ','.join(route[:2] + ['G.Q'] + route[2:]) if name == variables['route'] else read_text(name))
+    with caplog.at_level(logging.WARNING):
+        assert len(list(nc_parser._resolve_band_segments(variables))) == 2
+    assert [record.route_leg for record in caplog.records if hasattr(record, 'route_leg')] == ['G.Q']
+
+
+@pytest.mark.parametrize('quantities, n_systems, n_methods, n_sccs', [
+    ({'energies'}, 0, 0, 3), ({'system'}, 3, 0, 0), ({'method'}, 0, 1, 0), ({'system', 'forces'}, 3, 0, 3)])
+def test_quantities(tmp_path, quantities, n_systems, n_methods, n_sccs):
+    filename = str(tmp_path / 'quantities.nc')
+    write_netcdf(filename, n_configurations=3)
+    archive = EntryArchive()
+    ATKParser(quantities=quantities).parse(filename, archive, None)
+
+    sec_run = archive.section_run[0]
+    assert len(sec_run.section_system) == n_systems
+    assert len(sec_run.section_method) == n_methods
+    assert len(sec_run.section_single_configuration_calculation) == n_sccs
+    for sec_scc in sec_run.section_single_configuration_calculation:
+        assert (sec_scc.energy_total is not None) == ('energies' in quantities)
+        assert (sec_scc.atom_forces is not None) == ('forces' in quantities)
+        assert (sec_scc.single_configuration_calculation_to_system_ref is not None) == ('system' in quantities)
+
+
+def test_quantities_nc_parser(tmp_path):
+    filename = str(tmp_path / 'quantities.nc')
+    write_netcdf(filename, n_configurations=2)
+    nc_parser = NCParser()
+    nc_parser.quantities = {'energies'}
+    nc_parser.mainfile = filename
+    for configuration in nc_parser.get('configurations').values():
+        # handles of untouched variables are not even created
+        assert not configuration.has_forces
+        assert configuration.parameters is None
+        assert len(configuration.energies[0]) > 0
+
+    with pytest.raises(ValueError):
+        ATKParser().parse(filename, EntryArchive(), None, quantities={'energy'})
+
+
+def test_reuse(tmp_path):
+    filenames = [str(tmp_path / ('reuse_%d.nc' % n)) for n in range(3)]
+    for n, filename in enumerate(filenames):
+        write_netcdf(filename, n_configurations=n + 1, seed=n)
+
+    with ATKParser() as parser:
+        for n, filename in enumerate(filenames):
+            archive = EntryArchive()
+            parser.parse(filename, archive, None)
+            # the previous file is closed and none of its state is carried over
+            assert len(parser.pool) == 1
+            assert len(archive.section_run[0].section_system) == n + 1
+    assert len(parser.pool) == 0
+    assert parser.nc_parser._file_handler is None
+
+
+def test_lazy_pool(tmp_path):
+    parser = ATKParser(lazy=True, max_open=2)
+    archives = []
+    for n in range(4):
+        filename = str(tmp_path / ('pool_%d.nc' % n))
+        write_netcdf(filename, n_configurations=2, seed=n)
+        archive = EntryArchive()
+        for _ in parser.iter_sections(filename, archive, None):
+            pass
+        archives.append((filename, archive))
+        assert len(parser.pool) <= 2
+
+    for filename, archive in archives:
+        # the files of the first archives were closed and are reopened on access
+        materialize(archive)
+        reference = EntryArchive()
+        ATKParser().parse(filename, reference, None)
+        for section in ['section_system', 'section_single_configuration_calculation']:
+            quantity = 'atom_positions' if section == 'section_system' else 'atom_forces'
+            for sec, ref in zip(archive.section_run[0][section], reference.section_run[0][section]):
+                assert getattr(sec, quantity).magnitude == approx(getattr(ref, quantity).magnitude)
+        assert len(parser.pool) <= 2
+
+    parser.reset()
+    assert len(parser.pool) == 0
+
+
+def test_incremental(tmp_path):
+    filename = str(tmp_path / 'growing.nc')
+    parser = ATKParser(incremental=True)
+    archive = EntryArchive()
+
+    # the forces of the running job are not written yet
+    write_netcdf(filename, n_configurations=2, forces=False)
+    sections = [section.m_def.name for section in parser.iter_sections(filename, archive, None)]
+    assert sections == [
+        'Run', 'System', 'Method', 'SingleConfigurationCalculation', 'System', 'SingleConfigurationCalculation']
+    sec_run = archive.section_run[0]
+    sec_systems = list(sec_run.section_system)
+
+    write_netcdf(filename, n_configurations=4)
+    sections = list(parser.iter_sections(filename, archive, None))
+    # results of the parsed configurations are added to their calculations
+    assert sections[:2] == list(sec_run.section_single_configuration_calculation[:2])
+    assert [section.m_def.name for section in sections[2:]] == ['System', 'SingleConfigurationCalculation'] * 2
+    assert len(archive.section_run) == 1
+    assert len(sec_run.section_method) == 1
+    assert list(sec_run.section_system[:2]) == sec_systems
+    assert len(sec_run.section_system) == 4
+    assert len(sec_run.section_single_configuration_calculation) == 4
+    for sec_scc in sec_run.section_single_configuration_calculation:
+        assert sec_scc.atom_forces is not None
+        assert sec_scc.single_configuration_to_calculation_method_ref == sec_run.section_method[0]
+
+    # nothing is parsed again for an unchanged file, a new archive is parsed from scratch
+    assert list(parser.iter_sections(filename, archive, None)) == []
+    reference = EntryArchive()
+    parser.parse(filename, reference, None)
+    assert len(reference.section_run[0].section_system) == 4
+    assert sec_run.section_single_configuration_calculation[-1].energy_total.magnitude == approx(
+        reference.section_run[0].section_single_configuration_calculation[-1].energy_total.magnitude)
@@ -0,0 +1,92 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+import shutil
+import pytest
+
+from atkparser import batch
+from atkparser.__main__ import main
+from atkparser.batch import parse_files, stream_files
+from synthetic import write_netcdf, write_foreign_netcdf
+
+
+def test_parse_files(tmp_path):
+    for n in range(3):
+        write_netcdf(str(tmp_path / ('synthetic_%d.nc' % n)), n_configurations=n + 1)
+    shutil.copy('tests/data/Si2.nc', str(tmp_path / 'Si2.nc'))
+    with open(str(tmp_path / 'broken.nc'), 'w') as f:
+        f.write('not a netcdf file')
+    # broken files are only parsed when given explicitly, foreign files in directories are skipped
+    write_foreign_netcdf(str(tmp_path / 'foreign.nc'))
+
+    results = {
+        os.path.basename(filepath): (archive, error)
+        for filepath, archive, error in parse_files([str(tmp_path), str(tmp_path / 'broken.nc')], workers=2)}
+
+    assert len(results) == 5
+    assert 'foreign.nc' not in results
+    assert results['broken.nc'][0] is None
+    assert 'NetCDF' in results['broken.nc'][1]
+    archive, error = results['synthetic_2.nc']
+    assert error is None
+    assert len(archive['section_run'][0]['section_single_configuration_calculation']) == 3
+    assert results['Si2.nc'][0]['section_run'][0]['program_version'] == 'ATK 2016.0.3'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stream_files(tmp_path, capsys, workers):
+    for n in range(2):
+        write_netcdf(str(tmp_path / ('synthetic_%d.nc' % n)), n_configurations=n + 1)
+    with open(str(tmp_path / 'broken.nc'), 'w') as f:
+        f.write('not a netcdf file')
+    # broken files are only parsed when given explicitly, foreign files in directories are skipped
+    write_foreign_netcdf(str(tmp_path / 'foreign.nc'))
+
+    records = dict()
+    errors = dict()
+    for filepath, record, error in stream_files([str(tmp_path), str(tmp_path / 'broken.nc')], workers=workers):
+        if error is None:
+            records.setdefault(os.path.basename(filepath), []).append(record['section'])
+        else:
+            errors[os.path.basename(filepath)] = error
+
+    assert list(errors) == ['broken.nc']
+    assert 'foreign.nc' not in records
+    assert 'NetCDF' in errors['broken.nc']
+    assert records['synthetic_1.nc'].count('section_single_configuration_calculation') == 2
+
+    # a bad file is reported without aborting the other files and fails the run
+    assert main(['--jsonl', '--workers', str(workers), str(tmp_path), str(tmp_path / 'broken.nc')]) == 1
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [line['mainfile'] for line in lines if 'error' in line] == [str(tmp_path / 'broken.nc')]
+    assert len(lines) == sum(len(sections) for sections in records.values()) + 1
+
+
+def test_stream_single_file(tmp_path, capsys, monkeypatch):
+    filename = str(tmp_path / 'synthetic.nc')
+    write_netcdf(filename, n_configurations=2)
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a single file is streamed in process')
+
+    monkeypatch.setattr(batch, 'ProcessPoolExecutor', no_pool)
+    assert main(['--jsonl', filename]) == 0
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [line['section'] for line in lines].count('section_single_configuration_calculation') == 2
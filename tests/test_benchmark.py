@@ -0,0 +1,269 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pytest
+
+from nomad.datamodel import EntryArchive
+from atkparser import ATKParser
+from atkparser.atk_parser import NCParser, HDF5Parser
+from synthetic import write_netcdf, write_hdf5
+
+
+# the timings depend on the machine and the soak test takes minutes, they only run on request
+benchmark_only = pytest.mark.skipif(
+    not os.environ.get('ATK_BENCHMARK'), reason='benchmarks only run with ATK_BENCHMARK=1')
+
+
+def time_nc_parser(filename, keys):
+    nc_parser = NCParser()
+    start = time.perf_counter()
+    nc_parser.mainfile = filename
+    for key in keys:
+        nc_parser.get(key)
+    return time.perf_counter() - start
+
+
+def benchmark(func, rounds=3):
+    '''
+    Runs func rounds times and returns the minimum and mean wall time and the peak of the
+    memory allocated by python during a run.
+    '''
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(min=min(timings), mean=sum(timings) / rounds, peak=peak)
+
+
+@benchmark_only
+@pytest.mark.parametrize('name, kwargs', [
+    ('single', dict()),
+    ('trajectory', dict(n_configurations=200, n_atoms=64, velocities=True)),
+    ('large', dict(n_atoms=20000)),
+    ('molecules', dict(n_configurations=50, n_atoms=32, molecule=True, calculator=False, forces=False))])
+def test_parse_benchmark(tmp_path, name, kwargs):
+    filename = str(tmp_path / ('%s.nc' % name))
+    write_netcdf(filename, **kwargs)
+
+    def nc_parser():
+        time_nc_parser(filename, ['configuration_names', 'atoms', 'parameters', 'energies', 'forces'])
+
+    def atk_parser():
+        archive = EntryArchive()
+        ATKParser().parse(filename, archive, None)
+        return archive
+
+    results = dict(nc_parser=benchmark(nc_parser), atk_parser=benchmark(atk_parser))
+    for parser, result in results.items():
+        print('%s %s: min %.4fs mean %.4fs peak %.1f kB' % (
+            name, parser, result['min'], result['mean'], result['peak'] / 1024))
+
+    sec_run = atk_parser().section_run[0]
+    assert len(sec_run.section_system) == kwargs.get('n_configurations', 1)
+
+
+@benchmark_only
+def test_energies_benchmark(tmp_path):
+    filename = str(tmp_path / 'energies.nc')
+    write_netcdf(filename, n_configurations=200, n_atoms=256, velocities=True)
+
+    results = dict()
+    for name, quantities in [('all', None), ('energies', {'energies'})]:
+        def atk_parser():
+            ATKParser(quantities=quantities).parse(filename, EntryArchive(), None)
+
+        results[name] = benchmark(atk_parser)
+        print('%s quantities: min %.4fs mean %.4fs peak %.1f kB' % (
+            name, results[name]['min'], results[name]['mean'], results[name]['peak'] / 1024))
+
+    # energies only do not decode the configurations, calculators and forces
+    assert results['energies']['min'] < 0.5 * results['all']['min']
+
+
+@benchmark_only
+def test_variable_index_scaling(tmp_path):
+    keys = ['configuration_names', 'parameters', 'energies', 'forces']
+    timings = dict()
+    for n_configurations in [100, 800]:
+        filename = str(tmp_path / ('gids_%d.nc' % n_configurations))
+        write_netcdf(filename, n_configurations=n_configurations)
+        timings[n_configurations] = time_nc_parser(filename, keys) / n_configurations
+
+    print('time per configuration: %s' % timings)
+    # serving all keys from the index scales linearly with the number of variables
+    assert timings[800] < 3 * timings[100]
+
+
+def resolve_positions_regex(data):
+    # regex based decoding of the coordinates replaced by NCParser._to_array
+    re_f = r'[\d\.\-\+Ee]+'
+    data = data.data[:].copy().tobytes().decode()
+    coordinates = re.search(r'coordinates *\= *(\[\s*\[[\s\S]+?\]\s*\])', data)
+    return np.array([v.split(',') for v in re.findall(
+        rf'\[( *{re_f} *\, *{re_f} *\, *{re_f} *)\]', coordinates.group(1))], dtype=np.dtype(np.float64))
+
+
+def decode_positions(filename):
+    # the positions decoded with the regex and with NCParser and the time of both
+    nc_parser = NCParser()
+    nc_parser.mainfile = filename
+    name = nc_parser.get('configuration_names')[0]
+
+    start = time.perf_counter()
+    reference = resolve_positions_regex(nc_parser.netcdf.variables[name])
+    regex_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    structure = nc_parser._resolve_configuration(name, nc_parser.netcdf.variables[name])
+    decoder_time = time.perf_counter() - start
+
+    return reference, structure.positions @ np.linalg.inv(structure.cell), regex_time, decoder_time
+
+
+def test_configuration_decoder(tmp_path):
+    filename = str(tmp_path / 'large.nc')
+    write_netcdf(filename, n_configurations=1, n_atoms=2000)
+    reference, positions, _, _ = decode_positions(filename)
+    assert positions == pytest.approx(reference)
+
+
+@benchmark_only
+def test_configuration_decoder_benchmark(tmp_path):
+    filename = str(tmp_path / 'large.nc')
+    write_netcdf(filename, n_configurations=1, n_atoms=20000)
+    _, _, regex_time, decoder_time = decode_positions(filename)
+    print('regex: %.4fs decoder: %.4fs' % (regex_time, decoder_time))
+    assert decoder_time < regex_time
+
+
+def test_forces_memory(tmp_path):
+    if not os.path.isfile('/proc/self/clear_refs'):
+        pytest.skip('the peak resident memory can not be reset')
+    filename = str(tmp_path / 'forces.nc')
+    write_netcdf(filename, n_configurations=20, n_atoms=20000)
+    # peak resident memory of parsing in a fresh process, the peak (VmHWM) is reset
+    # before parsing so that only the allocations of the parser are accounted for
+    script = '\n'.join([
+        'import sys',
+        'from nomad.datamodel import EntryArchive',
+        'from atkparser import ATKParser',
+        'def status(key):',
+        '    return int([l for l in open("/proc/self/status") if l.startswith(key)][0].split()[1])',
+        'parser = ATKParser()',
+        'open("/proc/self/clear_refs", "w").write("5")',
+        'baseline = status("VmRSS")',
+        'parser.parse(sys.argv[1], EntryArchive(), None)',
+        'print(status("VmHWM") - baseline)'])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', script, filename], cwd=root, stdout=subprocess.PIPE, check=True)
+    # memory in the proc status is given in kilobytes
+    peak = int(result.stdout.decode().split()[-1]) * 1024
+    size = os.path.getsize(filename)
+
+    print('peak rss: %d file size: %d' % (peak, size))
+    # the mapped pages of the file and the archive arrays make up the bulk of the memory
+    assert peak < 3 * size
+
+
+def test_stream_memory(tmp_path):
+    filename = str(tmp_path / 'trajectory.nc')
+    write_netcdf(filename, n_configurations=10, n_atoms=2000)
+
+    def peak(func):
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    def parse():
+        archive = EntryArchive()
+        ATKParser().parse(filename, archive, None)
+        json.dumps(archive.m_to_dict())
+
+    def stream():
+        for record in ATKParser().stream(filename):
+            json.dumps(record)
+
+    parse_peak, stream_peak = peak(parse), peak(stream)
+    print('peak parse: %d stream: %d' % (parse_peak, stream_peak))
+    assert stream_peak < parse_peak / 3
+
+
+def test_hdf5_memory(tmp_path):
+    pytest.importorskip('h5py')
+    filename = str(tmp_path / 'trajectory.hdf5')
+    n_configurations, n_atoms = 20, 20000
+    write_hdf5(filename, n_configurations=n_configurations, n_atoms=n_atoms)
+
+    parser = HDF5Parser()
+    parser.mainfile = filename
+    tracemalloc.start()
+    for configuration in parser.get('configurations').values():
+        configuration.structure, configuration.forces
+        configuration.release()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # positions and forces of a single configuration
+    configuration_size = 2 * n_atoms * 3 * 8
+    print('peak: %d configuration: %d file: %d' % (peak, configuration_size, os.path.getsize(filename)))
+    assert peak < 3 * configuration_size
+
+
+@benchmark_only
+def test_soak(tmp_path):
+    psutil = pytest.importorskip('psutil')
+    if not os.path.isdir('/proc/self/fd'):
+        pytest.skip('open file descriptors can not be counted')
+
+    filenames = []
+    for n in range(2000):
+        filename = str(tmp_path / ('soak_%d.nc' % n))
+        write_netcdf(filename, n_configurations=2, n_atoms=16, seed=n % 10)
+        filenames.append(filename)
+
+    process = psutil.Process()
+    usage = []
+    with ATKParser() as parser:
+        for n, filename in enumerate(filenames):
+            parser.parse(filename, EntryArchive(), None)
+            if n in [200, len(filenames) - 1]:
+                usage.append((len(os.listdir('/proc/self/fd')), process.memory_info().rss))
+
+    print('open files: %d -> %d, rss: %.1f MB -> %.1f MB' % (
+        usage[0][0], usage[1][0], usage[0][1] / 1e6, usage[1][1] / 1e6))
+    # a single parser reused for all files neither leaks handles nor memory
+    assert usage[1][0] <= usage[0][0]
+    assert usage[1][1] - usage[0][1] < 16e6
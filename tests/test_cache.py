@@ -0,0 +1,182 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import logging
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from nomad.datamodel import EntryArchive
+from atkparser import ATKParser
+from atkparser.cache import ResultsCache
+from synthetic import write_netcdf, write_hdf5
+
+
+def test_cache(tmp_path):
+    filename = str(tmp_path / 'Si2.nc')
+    shutil.copy('tests/data/Si2.nc', filename)
+    cache = ResultsCache(str(tmp_path / 'cache'))
+
+    reference = EntryArchive()
+    ATKParser().parse(filename, reference, None)
+
+    archives = []
+    for _ in range(2):
+        parser = ATKParser(cache=cache)
+        archive = EntryArchive()
+        parser.parse(filename, archive, None)
+        archives.append(archive)
+
+    # the second parse is served from the cache without opening the NetCDF file
+    assert parser.nc_parser._file_handler is None
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+    for archive in archives:
+        sec_run = archive.section_run[0]
+        assert sec_run.program_version == 'ATK 2016.0.3'
+        sec_scc = sec_run.section_single_configuration_calculation[0]
+        assert sec_scc.energy_total.magnitude == pytest.approx(
+            reference.section_run[0].section_single_configuration_calculation[0].energy_total.magnitude)
+        assert sec_run.section_system[0].atom_labels == ['Si', 'Si']
+        assert sec_run.section_system[0].lattice_vectors.magnitude == pytest.approx(
+            reference.section_run[0].section_system[0].lattice_vectors.magnitude)
+        assert sec_run.section_method[0].smearing_width == pytest.approx(
+            reference.section_run[0].section_method[0].smearing_width)
+        reference_scc = reference.section_run[0].section_single_configuration_calculation[0]
+        assert sec_scc.stress_tensor.magnitude == pytest.approx(reference_scc.stress_tensor.magnitude)
+        assert sec_scc.energy_reference_fermi.magnitude == pytest.approx(reference_scc.energy_reference_fermi.magnitude)
+        segments = sec_scc.section_k_band[0].section_k_band_segment
+        reference_segments = reference_scc.section_k_band[0].section_k_band_segment
+        assert [segment.band_segm_labels for segment in segments] == [
+            segment.band_segm_labels for segment in reference_segments]
+        assert segments[-1].band_energies.magnitude == pytest.approx(reference_segments[-1].band_energies.magnitude)
+
+    # a modified file is not served from the stale entry
+    os.utime(filename, ns=(0, 0))
+    parser.parse(filename, EntryArchive(), None)
+    assert parser.nc_parser._file_handler is not None
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+
+
+def test_cache_eviction(tmp_path):
+    cache = ResultsCache(str(tmp_path / 'cache'))
+    filenames = []
+    for n in range(3):
+        filenames.append(str(tmp_path / ('synthetic_%d.nc' % n)))
+        write_netcdf(filenames[-1], n_configurations=2)
+
+    for filename in filenames:
+        ATKParser(cache=cache).parse(filename, EntryArchive(), None)
+    sizes = [os.path.getsize(os.path.join(cache.directory, f)) for f in os.listdir(cache.directory)]
+    assert len(sizes) == 3
+
+    # reading the first entry makes the second one the least recently used
+    os.utime(os.path.join(cache.directory, '%s.npz' % cache.key(filenames[1])), ns=(0, 0))
+    assert cache.get(cache.key(filenames[0])) is not None
+    cache.max_size = sum(sizes) - 1
+    cache.evict()
+    assert cache.get(cache.key(filenames[1])) is None
+    assert cache.get(cache.key(filenames[0])) is not None
+    assert cache.get(cache.key(filenames[2])) is not None
+
+
+def test_cache_threads(tmp_path, monkeypatch, caplog):
+    filename = str(tmp_path / 'synthetic.nc')
+    write_netcdf(filename, n_configurations=4)
+    cache = ResultsCache(str(tmp_path / 'cache'))
+
+    def parse(_):
+        archive = EntryArchive()
+        ATKParser(cache=cache).parse(filename, archive, None)
+        return len(archive.section_run[0].section_single_configuration_calculation)
+
+    # threads which write the same entry at the same time
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(parse, range(8))) == [4] * 8
+    assert os.listdir(cache.directory) == ['%s.npz' % cache.key(filename)]
+
+    # an entry which can not be moved into place is not written, the parse succeeds
+    os.remove(os.path.join(cache.directory, os.listdir(cache.directory)[0]))
+
+    def replace(src, dst):
+        raise OSError('No such file')
+
+    monkeypatch.setattr(os, 'replace', replace)
+    with caplog.at_level(logging.WARNING):
+        assert parse(0) == 4
+    assert 'Could not write results cache' in caplog.text
+    assert os.listdir(cache.directory) == []
+
+
+def test_cache_entry_closed(tmp_path, monkeypatch):
+    if not os.path.isdir('/proc/self/fd'):
+        pytest.skip('open files can not be listed')
+
+    def open_entries():
+        return [
+            path for path in (os.path.realpath('/proc/self/fd/%s' % fd) for fd in os.listdir('/proc/self/fd'))
+            if path.startswith(str(tmp_path / 'cache'))]
+
+    filename = str(tmp_path / 'synthetic.nc')
+    write_netcdf(filename, n_configurations=3)
+    cache = ResultsCache(str(tmp_path / 'cache'))
+    for _ in range(2):
+        archive = EntryArchive()
+        ATKParser(cache=cache).parse(filename, archive, None)
+        assert len(archive.section_run[0].section_single_configuration_calculation) == 3
+        assert open_entries() == []
+    assert len(os.listdir(cache.directory)) == 1
+
+    # a corrupt entry which is removed concurrently is a cache miss
+    key = cache.key(filename)
+    with open(os.path.join(cache.directory, '%s.npz' % key), 'wb') as f:
+        f.write(b'corrupt')
+    # the second unlink fails like a removal which lost the race against another process
+    monkeypatch.setattr(os, 'remove', lambda path: os.unlink(path) or os.unlink(path))
+    assert cache.get(key) is None
+    assert open_entries() == []
+
+
+@pytest.mark.parametrize('extension, fingerprint_table', [('nc', True), ('hdf5', True), ('hdf5', False)])
+def test_cache_key(tmp_path, extension, fingerprint_table):
+    # files of the same size and modification time, e.g. extracted from an archive
+    if extension == 'hdf5':
+        h5py = pytest.importorskip('h5py')
+    filenames = [str(tmp_path / ('synthetic%d.%s' % (seed, extension))) for seed in range(2)]
+    for seed, filename in enumerate(filenames):
+        if extension == 'hdf5':
+            write_hdf5(filename, seed=seed)
+            if not fingerprint_table:
+                with h5py.File(filename, 'a') as f:
+                    del f.attrs['fingerprint_table']
+        else:
+            write_netcdf(filename, seed=seed)
+        os.utime(filename, ns=(0, 0))
+    assert os.path.getsize(filenames[0]) == os.path.getsize(filenames[1])
+
+    cache = ResultsCache(str(tmp_path / 'cache'))
+    assert cache.key(filenames[0]) != cache.key(filenames[1])
+    positions = []
+    for filename in filenames:
+        for parser in [ATKParser(hdf5=True), ATKParser(hdf5=True, cache=cache)]:
+            archive = EntryArchive()
+            parser.parse(filename, archive, None)
+            positions.append(archive.section_run[0].section_system[0].atom_positions.magnitude)
+    assert positions[0] == pytest.approx(positions[1])
+    assert positions[2] == pytest.approx(positions[3])
+    assert positions[0] != pytest.approx(positions[2])